@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+# Benchmarks for kbparse.py on synthetic schedules. Nothing here talks to the portal.
+
+import argparse
+import ast
+import concurrent.futures
+import datetime as dt
+import io
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import List, Tuple
+
+import fakeportal
+import kbparse
+
+benchFirstDay = dt.date(2020, 2, 17)
+benchTermName = fakeportal.termNameOf(benchFirstDay)
+
+def syntheticWeeks(courses: int, weeks: int, seed: int = 0) -> list:
+    """
+    Parsed weeks of a term with `courses` courses over `weeks` weeks, as
+    fakeportal serves them.
+    """
+    portal = fakeportal.FakePortal(courses=courses, weeks=weeks, firstDay=benchFirstDay, seed=seed)
+    return [kbparse.parseClassData(portal.weekData(benchFirstDay + kbparse.oneWeek * (w - 1))) for w in range(1, weeks + 1)]
+
+def syntheticSchedule(courses: int, weeks: int, seed: int = 0) -> kbparse.USchedule:
+    schedule = kbparse.USchedule(benchTermName, benchFirstDay)
+    schedule.addWeeks(syntheticWeeks(courses, weeks, seed))
+    return schedule
+
+def best(f, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def withoutDTSTAMP(ical: str) -> str:
+    return re.sub(r'DTSTAMP:[0-9TZ]+\r\n', '', ical)
+
+def benchICal(options):
+    """
+    Compare the icalendar object model (toICal) with the streaming writer
+    (writeICal) on the same schedule.
+    """
+    print('{:>8} {:>6} {:>8} {:>12} {:>12} {:>8}'.format('courses', 'weeks', 'events', 'icalendar/s', 'stream/s', 'speedup'))
+    for courses in options.courses:
+        schedule = syntheticSchedule(courses, options.weeks, options.seed)
+        events = sum(1 for _ in schedule.iterICalEvents(useLocation=False))
+        buf = io.StringIO()
+        tObject = best(lambda: schedule.toICal(useLocation=False), options.repeat)
+        tStream = best(lambda: schedule.writeICal(io.StringIO(), useLocation=False), options.repeat)
+        schedule.writeICal(buf, useLocation=False)
+        if withoutDTSTAMP(buf.getvalue()) != withoutDTSTAMP(schedule.toICal(useLocation=False)):
+            raise Exception('Streaming output differs from icalendar output')
+        print('{:>8} {:>6} {:>8} {:>12.4f} {:>12.4f} {:>7.1f}x'.format(courses, options.weeks, events, tObject, tStream, tObject / tStream))
+
+def benchMerge(options):
+    """
+    Merge synthetic weeks one by one (addWeek) and all at once (addWeeks).
+    """
+    print('{:>8} {:>6} {:>8} {:>12} {:>12}'.format('courses', 'weeks', 'slots', 'addWeek/s', 'addWeeks/s'))
+    for courses in options.courses:
+        def merge(bulk: bool) -> float:
+            times = []
+            for _ in range(options.repeat):
+                weeks = syntheticWeeks(courses, options.weeks, options.seed)
+                schedule = kbparse.USchedule(benchTermName, benchFirstDay)
+                start = time.perf_counter()
+                if bulk:
+                    schedule.addWeeks(weeks)
+                else:
+                    for w in weeks:
+                        schedule.addWeek(w)
+                times.append(time.perf_counter() - start)
+            return min(times)
+        slots = sum(len(w.coursePeriods) for w in syntheticWeeks(courses, options.weeks, options.seed))
+        print('{:>8} {:>6} {:>8} {:>12.4f} {:>12.4f}'.format(courses, options.weeks, slots, merge(False), merge(True)))
+
+def benchSnapshot(options):
+    """
+    Parse and merge the weeks of a term against loading its snapshot; the
+    exports of both must be the same.
+    """
+    print('{:>8} {:>6} {:>12} {:>12} {:>12} {:>8}'.format('courses', 'weeks', 'parse/s', 'load/s', 'size/KiB', 'speedup'))
+    path = os.path.join(options.dir, 'bench.kbss')
+    for courses in options.courses:
+        portal = fakeportal.FakePortal(courses=courses, weeks=options.weeks, firstDay=benchFirstDay, seed=options.seed)
+        bodies = [portal.body(benchFirstDay + kbparse.oneWeek * (w - 1)) for w in range(1, options.weeks + 1)]
+        def parse() -> kbparse.USchedule:
+            schedule = kbparse.USchedule(benchTermName, benchFirstDay)
+            schedule.addWeeks(kbparse.parseClassData(kbparse.loadJSON(b)['d']) for b in bodies)
+            return schedule
+        schedule = parse()
+        kbparse.ScheduleSnapshot.save(path, ['bench'], [schedule])
+        _, loaded = kbparse.ScheduleSnapshot.load(path)
+        if withoutDTSTAMP(loaded[0].toICal(useLocation=False)) != withoutDTSTAMP(schedule.toICal(useLocation=False)):
+            raise Exception('Schedule loaded from snapshot differs')
+        tParse = best(parse, options.repeat)
+        tLoad = best(lambda: kbparse.ScheduleSnapshot.load(path), options.repeat)
+        print('{:>8} {:>6} {:>12.4f} {:>12.4f} {:>12.1f} {:>7.1f}x'.format(courses, options.weeks, tParse, tLoad, os.path.getsize(path) / 1024, tParse / tLoad))
+    os.remove(path)
+
+def deepSize(obj, seen: set = None) -> int:
+    """
+    Bytes used by obj and everything it references, counting objects in
+    `seen` (e.g. shared with an earlier call) only once.
+    """
+    seen = set() if seen is None else seen
+    stack = [obj]
+    total = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, type):
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        if hasattr(o, '__dict__'):
+            stack.append(vars(o))
+        for cls in type(o).__mro__:
+            for slot in getattr(cls, '__slots__', ()):
+                if hasattr(o, slot):
+                    stack.append(getattr(o, slot))
+    return total
+
+class ListCourseTime:
+    """
+    The list-based UCourseTime layout kbparse used before the bitmask one:
+    an instance __dict__ with lists of weeks, periods and teachers and an
+    extraInfo dict, and strings as fresh as json.loads() returns them.
+    """
+    def __init__(self, t: kbparse.UCourseTime):
+        fresh = lambda x: x.encode().decode()
+        self.periods = list(t.periods)
+        self.location = fresh(t.location)
+        self.teachers = [fresh(x) for x in t.teachers]
+        self.extraInfo = {}
+        self.weeks = list(t.weeks)
+        self.dayOfWeek = t.dayOfWeek
+        self.classroom = fresh(t.classroom)
+        self.name = fresh(t.name)
+        self.courseID = fresh(t.courseID)
+
+def benchMemory(options):
+    """
+    Memory held by the slots of a schedule, compared with the list-based
+    layout. With several students the interned strings and teacher tuples
+    are shared between their schedules.
+    """
+    print('{:>8} {:>6} {:>9} {:>8} {:>12} {:>12} {:>8}'.format('courses', 'weeks', 'students', 'slots', 'lists/KiB', 'compact/KiB', 'saved'))
+    for courses in options.courses:
+        seenCompact, seenLists = set(), set()
+        compact = lists = slots = 0
+        alive = []  # ids in `seen` must not be reused
+        for student in range(options.students):
+            schedule = syntheticSchedule(courses, options.weeks, options.seed)
+            ts = [t for c in schedule.courses for t in c.time]
+            legacy = [ListCourseTime(t) for t in ts]
+            alive.append((ts, legacy))
+            slots += len(ts)
+            compact += deepSize(ts, seenCompact)
+            lists += deepSize(legacy, seenLists)
+        print('{:>8} {:>6} {:>9} {:>8} {:>12.0f} {:>12.0f} {:>7.0%}'.format(courses, options.weeks, options.students, slots, lists / 1024, compact / 1024, 1 - compact / lists))
+
+def peakMemory(f) -> int:
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def benchCSV(options):
+    """
+    Build the whole CSV as a string (toCSV) vs stream rows to a file (writeCSV).
+    """
+    print('{:>8} {:>6} {:>8} {:>10} {:>10} {:>12} {:>12}'.format('courses', 'weeks', 'rows', 'string/s', 'stream/s', 'string/KiB', 'stream/KiB'))
+    for courses in options.courses:
+        schedule = syntheticSchedule(courses, options.weeks, options.seed)
+        with open(os.devnull, 'w', newline='') as sink:
+            rows = schedule.writeCSV(sink, useLocation=False)
+            tString = best(lambda: sink.write(schedule.toCSV(useLocation=False)), options.repeat)
+            tStream = best(lambda: schedule.writeCSV(sink, useLocation=False), options.repeat)
+            mString = peakMemory(lambda: sink.write(schedule.toCSV(useLocation=False)))
+            mStream = peakMemory(lambda: schedule.writeCSV(sink, useLocation=False))
+        print('{:>8} {:>6} {:>8} {:>10.4f} {:>10.4f} {:>12.0f} {:>12.0f}'.format(courses, options.weeks, rows, tString, tStream, mString / 1024, mStream / 1024))
+
+def occurrences(events) -> set:
+    """
+    Start times of all occurrences of the events, with their recurrences
+    expanded.
+    """
+    result = set()
+    for e in events:
+        interval, count = e.rrule or (0, 1)
+        starts = {e.dtstart + kbparse.oneWeek * interval * k for k in range(count)}
+        result |= (starts - set(e.exdates)) | set(e.rdates)
+    return result
+
+def benchRecurrence(options):
+    """
+    Greedy runs vs one event per slot with EXDATE/RDATE: number of events,
+    size and time of the streamed calendar.
+    """
+    print('{:>8} {:>6} {:>12} {:>12} {:>12} {:>12} {:>10} {:>10}'.format('courses', 'weeks', 'greedy/ev', 'compact/ev', 'greedy/KiB', 'compact/KiB', 'greedy/s', 'compact/s'))
+    for courses in options.courses:
+        schedule = syntheticSchedule(courses, options.weeks, options.seed)
+        row = []
+        for recurrence in ['greedy', 'compact']:
+            events = list(schedule.iterICalEvents(useLocation=False, recurrence=recurrence))
+            buf = io.StringIO()
+            schedule.writeICal(buf, useLocation=False, recurrence=recurrence)
+            t = best(lambda: schedule.writeICal(io.StringIO(), useLocation=False, recurrence=recurrence), options.repeat)
+            row.append((events, len(buf.getvalue().encode()), t))
+        if occurrences(row[0][0]) != occurrences(row[1][0]):
+            raise Exception('Compact recurrences do not cover the same occurrences')
+        (gEvents, gSize, gTime), (cEvents, cSize, cTime) = row
+        print('{:>8} {:>6} {:>12} {:>12} {:>12.0f} {:>12.0f} {:>10.4f} {:>10.4f}'.format(courses, options.weeks, len(gEvents), len(cEvents), gSize / 1024, cSize / 1024, gTime, cTime))
+
+def importTime() -> Tuple[float, list]:
+    """
+    Cumulative import time of kbparse in a fresh interpreter, in seconds,
+    and which of the heavy dependencies the import pulled in.
+    """
+    code = 'import kbparse, sys; print([m for m in {!r} if m in sys.modules])'.format(heavyModules)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=os.path.dirname(os.path.abspath(kbparse.__file__)), capture_output=True, text=True, check=True)
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == 'kbparse':
+            return int(fields[1]) / 1e6, ast.literal_eval(result.stdout.strip())
+    raise Exception('No import time for kbparse in:\n' + result.stderr)
+
+def runTime(args: List[str]) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, kbparse.__file__] + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+def benchStartup(options) -> int:
+    """
+    Import time of kbparse (-X importtime) and wall time of `kbparse.py -h`,
+    best of --repeat runs, against a budget in milliseconds. Importing must
+    not load requests, icalendar or pytz. Exits 1 if over budget.
+    """
+    imports = [importTime() for _ in range(options.repeat)]
+    tImport = min(t for t, _ in imports)
+    loaded = imports[0][1]
+    tHelp = min(runTime(['-h']) for _ in range(options.repeat))
+    print('{:>12} {:>12} {:>12}  {}'.format('import/ms', 'budget/ms', '-h/ms', 'heavy modules loaded'))
+    print('{:>12.1f} {:>12.1f} {:>12.1f}  {}'.format(tImport * 1000, options.budget, tHelp * 1000, ', '.join(loaded) or '-'))
+    failed = False
+    if tImport * 1000 > options.budget:
+        print('over budget: importing kbparse took {:.1f}ms'.format(tImport * 1000))
+        failed = True
+    if loaded:
+        print('importing kbparse loaded {}'.format(', '.join(loaded)))
+        failed = True
+    return 1 if failed else 0
+
+heavyModules = ['requests', 'icalendar', 'pytz']
+
+suitePhases = ['fetch', 'parse', 'merge', 'ical', 'stream', 'csv', 'pipeline']
+
+def benchSuite(options) -> int:
+    """
+    Time every phase against fakeportal: fetching raw weeks, parsing them,
+    merging them into a schedule, exporting, and all of fetchSchedule()
+    (which also finds the end of the term). Results can be saved as JSON and
+    compared with an earlier run; phases that got slower than the baseline
+    by more than --tolerance are reported and make the exit status 1.
+    """
+    results = []
+    print('{:>8} {:>6}  {}'.format('courses', 'weeks', '  '.join('{:>10}'.format(p + '/s') for p in suitePhases)))
+    for courses in options.courses:
+        portal = fakeportal.FakePortal(courses=courses, weeks=options.weeks, firstDay=benchFirstDay, seed=options.seed, latency=options.latency, jitter=options.jitter, errorRate=options.errorRate)
+        server = portal.serve()
+        uri = 'http://127.0.0.1:{}{}'.format(server.server_port, fakeportal.classesPath)
+        transport = kbparse.Transport(poolSize=options.jobs, backoff=options.backoff)
+        dates = [(benchFirstDay + kbparse.oneWeek * (w - 1)).isoformat() for w in range(1, options.weeks + 1)]
+        phases = {}
+        try:
+            def fetch():
+                with concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) as executor:
+                    return list(executor.map(lambda d: kbparse.fetchClassData(d, 'bench', uri, transport=transport), dates))
+            raw = fetch()
+            phases['fetch'] = best(fetch, options.repeat)
+            phases['parse'] = best(lambda: [kbparse.parseClassData(d) for d in raw], options.repeat)
+            weeks = [kbparse.parseClassData(d) for d in raw]
+            def merge() -> kbparse.USchedule:
+                schedule = kbparse.USchedule(portal.termName, benchFirstDay)
+                for w in weeks:
+                    schedule.addWeek(w)
+                return schedule
+            phases['merge'] = best(merge, options.repeat)
+            schedule = merge()
+            phases['ical'] = best(lambda: schedule.toICal(useLocation=False), options.repeat)
+            phases['stream'] = best(lambda: schedule.writeICal(io.StringIO(), useLocation=False), options.repeat)
+            phases['csv'] = best(lambda: schedule.toCSV(useLocation=False), options.repeat)
+            before = portal.requests
+            phases['pipeline'] = best(lambda: kbparse.fetchSchedule('bench', benchFirstDay, [(1, float('inf'))], options.weeks + 6, uri, jobs=options.jobs, transport=transport), options.repeat)
+            requests = (portal.requests - before) // options.repeat
+        finally:
+            server.shutdown()
+            server.server_close()
+            transport.close()
+        results.append({'courses': courses, 'weeks': options.weeks, 'slots': sum(len(w.coursePeriods) for w in weeks), 'requests': requests, 'phases': phases})
+        print('{:>8} {:>6}  {}'.format(courses, options.weeks, '  '.join('{:>10.4f}'.format(phases[p]) for p in suitePhases)))
+
+    data = {'version': 1, 'created': dt.datetime.now().isoformat(timespec='seconds'), 'python': sys.version.split()[0],
+            'config': {k: getattr(options, k) for k in ['weeks', 'seed', 'repeat', 'jobs', 'latency', 'jitter', 'errorRate']}, 'results': results}
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(data, f, indent=2)
+    if not options.baseline:
+        return 0
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    if baseline['config'] != data['config']:
+        print('warning: baseline was run with {}'.format(baseline['config']))
+    old = {r['courses']: r['phases'] for r in baseline['results']}
+    regressions = 0
+    for r in results:
+        for phase, t in r['phases'].items():
+            ref = old.get(r['courses'], {}).get(phase)
+            # ignore differences below a millisecond, they are mostly noise
+            if ref is not None and t > ref * (1 + options.tolerance) and t - ref > 1e-3:
+                print('regression: {} with {} courses took {:.4f}s, was {:.4f}s (+{:.0%})'.format(phase, r['courses'], t, ref, t / ref - 1))
+                regressions += 1
+    return 1 if regressions else 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for kbparse.py')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, the best one is reported')
+    sub = parser.add_subparsers(dest='bench', required=True)
+    p = sub.add_parser('ical', help='icalendar object model vs streaming writer')
+    p.add_argument('--courses', type=int, nargs='+', default=[50, 500, 2000])
+    p.add_argument('--weeks', type=int, default=20)
+    p.set_defaults(func=benchICal)
+    p = sub.add_parser('csv', help='CSV built in memory vs streamed rows')
+    p.add_argument('--courses', type=int, nargs='+', default=[50, 500, 2000])
+    p.add_argument('--weeks', type=int, default=20)
+    p.set_defaults(func=benchCSV)
+    p = sub.add_parser('merge', help='merging parsed weeks into a schedule')
+    p.add_argument('--courses', type=int, nargs='+', default=[50, 500, 5000])
+    p.add_argument('--weeks', type=int, default=20)
+    p.set_defaults(func=benchMerge)
+    p = sub.add_parser('recurrence', help='greedy runs vs compact recurrences')
+    p.add_argument('--courses', type=int, nargs='+', default=[50, 500, 2000])
+    p.add_argument('--weeks', type=int, default=20)
+    p.set_defaults(func=benchRecurrence)
+    p = sub.add_parser('snapshot', help='parsing and merging vs loading a snapshot')
+    p.add_argument('--courses', type=int, nargs='+', default=[50, 500, 2000])
+    p.add_argument('--weeks', type=int, default=20)
+    p.add_argument('--dir', default='.', help='where the snapshot is written')
+    p.set_defaults(func=benchSnapshot)
+    p = sub.add_parser('suite', help='all phases against fakeportal, with JSON results and a baseline check')
+    p.add_argument('--courses', type=int, nargs='+', default=[50, 500, 2000])
+    p.add_argument('--weeks', type=int, default=20)
+    p.add_argument('-j', '--jobs', type=int, default=kbparse.defaultJobs)
+    p.add_argument('--latency', type=float, default=0.0, help='seconds fakeportal adds to every request')
+    p.add_argument('--jitter', type=float, default=0.0)
+    p.add_argument('--error-rate', dest='errorRate', type=float, default=0.0, help='fraction of requests fakeportal fails')
+    p.add_argument('--backoff', type=float, default=0.01, help='first retry delay of the transport')
+    p.add_argument('-o', '--output', help='save results to this JSON file')
+    p.add_argument('--baseline', help='compare with results saved earlier')
+    p.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline, default %(default)s')
+    p.set_defaults(func=benchSuite)
+    p = sub.add_parser('startup', help='import time of kbparse against a budget')
+    p.add_argument('--budget', type=float, default=100.0, help='allowed import time in milliseconds, default %(default)s')
+    p.set_defaults(func=benchStartup)
+    p = sub.add_parser('memory', help='memory held by the slots of a schedule')
+    p.add_argument('--courses', type=int, nargs='+', default=[50, 500])
+    p.add_argument('--weeks', type=int, default=20)
+    p.add_argument('--students', type=int, default=1, help='schedules held at the same time')
+    p.set_defaults(func=benchMemory)
+    options = parser.parse_args()
+    logging.getLogger().setLevel('ERROR')
+    return options.func(options)
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# A local stand-in for the schedule endpoint of the portal, serving synthetic
+# schedules, for benchmarks and for trying kbparse.py without an eai-sess:
+#   ./fakeportal.py --port 8765 --courses 30 &
+#   ./kbparse.py --uri http://127.0.0.1:8765/njukb/wap/default/classes -k x -t 20192
+
+import argparse
+import datetime as dt
+import json
+import logging
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Tuple
+from urllib.parse import parse_qs
+
+classesPath = '/njukb/wap/default/classes'
+defaultFirstDay = dt.date(2020, 2, 17)
+defaultTermWeeks = 18
+holidayName = '假期'
+
+def termNameOf(firstDay: dt.date) -> str:
+    if firstDay.month >= 8:
+        return '{}-{}学年上学期'.format(firstDay.year, firstDay.year + 1)
+    return '{}-{}学年下学期'.format(firstDay.year - 1, firstDay.year)
+
+def syntheticSlots(courses: int, weeks: int, seed: int = 0) -> list:
+    """
+    `courses` course slots over a term of `weeks` weeks, with a mix of
+    weekly, odd/even and irregular week patterns. Each is a kclist entry as
+    the portal returns it plus the set of its weeks under 'weeks'.
+    """
+    rng = random.Random(seed)
+    slots = []
+    for i in range(courses):
+        length = rng.randint(1, 3)
+        start = rng.randint(1, 13 - length)
+        pattern = rng.choice(['all', 'odd', 'even', 'irregular'])
+        if pattern == 'all':
+            ws = set(range(1, weeks + 1))
+        elif pattern == 'odd':
+            ws = set(range(1, weeks + 1, 2))
+        elif pattern == 'even':
+            ws = set(range(2, weeks + 1, 2))
+        else:
+            ws = set(w for w in range(1, weeks + 1) if rng.random() < 0.6)
+        slots.append({'lessArr': list(range(start, start + length)), 'course_name': '合成课程{}，第{}部分'.format(i // 2, i % 2), 'weekday': rng.randint(1, 7),
+                      'location': '仙林校区 {}楼{}'.format(rng.randint(1, 20), rng.randint(100, 500)), 'classroom': '教{}-{}'.format(rng.randint(1, 20), rng.randint(100, 500)),
+                      'teacher': '，'.join('教师{}'.format(rng.randint(1, 500)) for _ in range(rng.randint(1, 3))), 'course_id': '{:08d}'.format(i), 'weeks': ws})
+    return slots
+
+class FakePortal:
+    """
+    Answers schedule requests for one synthetic term starting on firstDay.
+    Weeks outside the term are holidays without courses. Every request is
+    delayed by `latency` (plus up to `jitter`) seconds and fails with HTTP
+    503 with probability errorRate.
+    """
+    def __init__(self, courses: int = 30, weeks: int = defaultTermWeeks, firstDay: dt.date = defaultFirstDay, seed: int = 0, latency: float = 0.0, jitter: float = 0.0, errorRate: float = 0.0):
+        self.firstDay = firstDay
+        self.weeks = weeks
+        self.termName = termNameOf(firstDay)
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.requests = self.errors = 0
+        self.__rng = random.Random(seed)
+        self.__lock = threading.Lock()
+        # week -> kclist, so that huge schedules are split up only once
+        self.__kclists = {}
+        for slot in syntheticSlots(courses, weeks, seed):
+            entry = {k: v for k, v in slot.items() if k != 'weeks'}
+            for w in slot['weeks']:
+                day = self.__kclists.setdefault(w, {}).setdefault(str(entry['weekday']), {})
+                day.setdefault(str(entry['lessArr'][0]), []).append(entry)
+        self.__bodies = {}
+
+    def weekNumberOf(self, date: dt.date) -> int:
+        """
+        The week of the term `date` is in, 0 if it is not in the term.
+        """
+        w = (date - self.firstDay).days // 7 + 1
+        return w if 1 <= w <= self.weeks else 0
+
+    def weekData(self, date: dt.date) -> dict:
+        """
+        The 'd' part of the response for the week containing `date`.
+        """
+        monday = date - dt.timedelta(days=date.weekday())
+        w = self.weekNumberOf(monday)
+        return {'dateInfo': {'name': '{} 第{}周'.format(self.termName, w) if w else holidayName},
+                'weekdays': [(monday + dt.timedelta(days=i)).isoformat() for i in range(7)],
+                'kclist': self.__kclists.get(w, {}) if w else {}}
+
+    def body(self, date: dt.date) -> bytes:
+        monday = date - dt.timedelta(days=date.weekday())
+        body = self.__bodies.get(monday)
+        if body is None:
+            body = json.dumps({'e': 0, 'm': '', 'd': self.weekData(monday)}, ensure_ascii=False).encode()
+            self.__bodies[monday] = body
+        return body
+
+    def handle(self, date: dt.date) -> Tuple[int, bytes]:
+        """
+        Return the HTTP status and body of a request for `date`.
+        """
+        with self.__lock:
+            self.requests += 1
+            delay = self.latency + self.__rng.uniform(0, self.jitter)
+            failed = self.__rng.random() < self.errorRate
+            if failed:
+                self.errors += 1
+        time.sleep(delay)
+        if failed:
+            return 503, b'Service Unavailable'
+        return 200, self.body(date)
+
+    def serve(self, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+        """
+        Start serving on a background thread; port 0 picks a free port. Stop
+        with shutdown() on the returned server.
+        """
+        server = ThreadingHTTPServer((host, port), makeHandler(self))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+def makeHandler(portal: FakePortal):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body are sent separately, don't let them wait for an ACK
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+        def reply(self, status: int, body: bytes, contentType: str = 'application/json'):
+            self.send_response(status)
+            self.send_header('Content-Type', contentType)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+            if self.path != classesPath:
+                return self.reply(404, b'Not Found', 'text/plain')
+            try:
+                date = dt.date.fromisoformat(parse_qs(body)['date'][0])
+            except (KeyError, ValueError):
+                return self.reply(200, json.dumps({'e': 1, 'm': 'bad date', 'd': {}}).encode())
+            self.reply(*portal.handle(date))
+
+        def do_GET(self):
+            # counters, for benchmarks
+            if self.path != '/stats':
+                return self.reply(404, b'Not Found', 'text/plain')
+            self.reply(200, json.dumps({'requests': portal.requests, 'errors': portal.errors}).encode())
+    return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description='A local stand-in for the schedule endpoint of the portal')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--courses', type=int, default=30, help='course slots in the term')
+    parser.add_argument('--weeks', type=int, default=defaultTermWeeks, help='weeks in the term')
+    parser.add_argument('--first-day', dest='firstDay', type=dt.date.fromisoformat, default=defaultFirstDay)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many more seconds, at random')
+    parser.add_argument('--error-rate', dest='errorRate', type=float, default=0.0, help='fraction of requests answered with HTTP 503')
+    parser.add_argument('--debug', action='store_true')
+    options = parser.parse_args()
+    logging.getLogger().setLevel('DEBUG' if options.debug else 'INFO')
+    portal = FakePortal(courses=options.courses, weeks=options.weeks, firstDay=options.firstDay, seed=options.seed,
+                        latency=options.latency, jitter=options.jitter, errorRate=options.errorRate)
+    server = ThreadingHTTPServer((options.host, options.port), makeHandler(portal))
+    server.daemon_threads = True
+    logging.info('Serving {} ({} weeks from {}) on http://{}:{}{}'.format(portal.termName, portal.weeks, portal.firstDay, options.host, server.server_port, classesPath))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -2,18 +2,27 @@
 # Copyright (C) 2020, 0xCLOVER.
 # All rights reserved.
 
+# requests, icalendar and pytz are imported where they are needed, so that
+# -h, CSV export and other short runs start quickly
 import logging
-import requests
 import json
 import datetime as dt, calendar
 import csv
 import sys, io, os
-import icalendar as ics
+import threading, time, random
+import concurrent.futures
 import argparse
-import pytz
 import re
 import uuid
-from typing import List, Iterable
+import hashlib, struct, zlib
+import collections, contextlib, bisect, copy, functools
+import urllib.parse
+from typing import List, Iterable, Iterator, Tuple
+try:
+    import orjson
+    loadJSON = orjson.loads
+except ImportError:
+    loadJSON = json.loads
 
 programName = 'kbparse.py'
 programVersion = '0.02'
@@ -21,31 +30,183 @@ programFullName = '{}-{}'.format(programName, programVersion)
 iCalVersion = '2.0'
 defaultOutputFormat = 'ics'
 supportedFileFormats = ['ics', 'csv']
+csvFieldNames = ['Subject', 'Start Date', 'Start Time', 'End Date', 'End Time', 'All Day Event', 'Description', 'Location', 'Private']
 defaultTermLength = 20
 defaultClassScheduleURI = 'https://wx.nju.edu.cn/njukb/wap/default/classes'
+defaultJobs = 4
+defaultTimeout = 15
+defaultRetries = 3
+defaultCacheSize = 64 * 1024 * 1024
+defaultPastTTL = 30 * 24 * 3600
+defaultCurrentTTL = 3600
 lessonLength = dt.timedelta(minutes=50)
 lessonStartTime = list(map(lambda x: x, ['08:00','09:00','10:10','11:10','14:00','15:00','16:10','17:10','18:30', '19:30','20:40','21:30']))
 #defaultFirstDay = '2020-02-17'
 oneWeek = dt.timedelta(days = 7)
-timeZone = pytz.timezone('Asia/Shanghai')
+uidNamespace = uuid.uuid5(uuid.NAMESPACE_DNS, 'wx.nju.edu.cn')
+timeZoneName = 'Asia/Shanghai'
 #timeZone = dt.timezone(dt.timedelta(hours=8))
-periodTimes = dict(
-    (lambda x: [(i+1, x[i]) for i in range(0, len(x))])(
-        list(map(lambda x: (dt.time.fromisoformat(x).replace(tzinfo=timeZone),
-                    #(dt.datetime.combine(dt.date.today(), dt.time.fromisoformat(x)) + lessonLength).time()),
-                    (dt.datetime.combine(dt.date.today(), dt.time.fromisoformat(x)) + lessonLength).time().replace(tzinfo=timeZone)),
-                lessonStartTime
-            )
-        )
-    )
-)
+# period -> (start, end), naive; see OccurrenceTable for aware ones
+periodTimes = {i + 1: (dt.time(m // 60, m % 60), dt.time((m + lessonLength.seconds // 60) // 60, (m + lessonLength.seconds // 60) % 60))
+               for i, m in enumerate(int(x[:2]) * 60 + int(x[3:]) for x in lessonStartTime)}
+
+@functools.lru_cache(maxsize=None)
+def getTimeZone():
+    # pytz zones must be attached with localize(), replace() gives LMT
+    import pytz
+    return pytz.timezone(timeZoneName)
+
+class OccurrenceTable:
+    """
+    Start and end of every period of every day of a term as aware
+    datetimes, in flat lists indexed by (week, weekday, period), so that
+    exporters look occurrences up instead of combining dates and times for
+    each one. Weeks are added up to the highest one asked for. Each week is
+    localized at its first and last period; only if the UTC offset changes
+    in between is every period localized on its own.
+    """
+    periodCount = len(lessonStartTime)
+
+    def __init__(self, firstDay: dt.date):
+        self.firstDay = firstDay
+        self.weeks = 0
+        self.starts = []
+        self.ends = []
+        self.__lock = threading.Lock()
+
+    def index(self, week: int, dayOfWeek: int, period: int) -> int:
+        if week >= self.weeks:
+            self.fill(week)
+        return (week * 7 + dayOfWeek - 1) * self.periodCount + period - 1
+
+    def start(self, week: int, dayOfWeek: int, period: int) -> dt.datetime:
+        return self.starts[self.index(week, dayOfWeek, period)]
+
+    def end(self, week: int, dayOfWeek: int, period: int) -> dt.datetime:
+        return self.ends[self.index(week, dayOfWeek, period)]
+
+    def fill(self, lastWeek: int):
+        tz = getTimeZone()
+        first, last = periodTimes[1][0], periodTimes[self.periodCount][1]
+        with self.__lock:
+            for week in range(self.weeks, lastWeek + 1):
+                # week 0 is the one before the term
+                monday = self.firstDay + oneWeek * (week - 1)
+                days = [monday + dt.timedelta(days=i) for i in range(7)]
+                a = tz.localize(dt.datetime.combine(days[0], first))
+                b = tz.localize(dt.datetime.combine(days[-1], last))
+                for date in days:
+                    for period in range(1, self.periodCount + 1):
+                        startTime, endTime = periodTimes[period]
+                        if a.utcoffset() == b.utcoffset():
+                            self.starts.append(dt.datetime.combine(date, startTime, a.tzinfo))
+                            self.ends.append(dt.datetime.combine(date, endTime, a.tzinfo))
+                        else:
+                            self.starts.append(tz.localize(dt.datetime.combine(date, startTime)))
+                            self.ends.append(tz.localize(dt.datetime.combine(date, endTime)))
+            self.weeks = max(self.weeks, lastWeek + 1)
+
+@functools.lru_cache(maxsize=32)
+def occurrenceTableOf(firstDay: dt.date) -> OccurrenceTable:
+    """
+    The table of the term starting on firstDay, shared by all of its slots.
+    """
+    return OccurrenceTable(firstDay)
+
+class Stats:
+    """
+    Timers, counters and samples (e.g. HTTP latencies) collected during a
+    run with --stats. The module-level `stats` is None unless enabled, and
+    every hook checks it first, so disabled hooks cost a global lookup.
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.timers = {}    # name -> [calls, seconds]
+        self.counters = {}
+        self.samples = {}
+
+    def time(self, name: str, seconds: float):
+        with self.__lock:
+            t = self.timers.setdefault(name, [0, 0.0])
+            t[0] += 1
+            t[1] += seconds
+
+    def count(self, name: str, n: int = 1):
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def sample(self, name: str, value: float):
+        with self.__lock:
+            self.samples.setdefault(name, []).append(value)
+
+    def raw(self) -> dict:
+        return {'timers': self.timers, 'counters': self.counters, 'samples': self.samples}
+
+    def merge(self, raw: dict):
+        """
+        Add what raw() of another Stats (e.g. of a batch worker) returned.
+        """
+        for name, (calls, seconds) in raw['timers'].items():
+            with self.__lock:
+                t = self.timers.setdefault(name, [0, 0.0])
+                t[0] += calls
+                t[1] += seconds
+        for name, n in raw['counters'].items():
+            self.count(name, n)
+        for name, values in raw['samples'].items():
+            with self.__lock:
+                self.samples.setdefault(name, []).extend(values)
+
+    @staticmethod
+    def percentile(values: List[float], p: float) -> float:
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    def toJSON(self) -> dict:
+        return {'timers': {k: {'calls': c, 'seconds': t} for k, (c, t) in sorted(self.timers.items())},
+                'counters': dict(sorted(self.counters.items())),
+                'samples': {k: dict({'count': len(v), 'max': max(v)}, **{'p{}'.format(p): self.percentile(v, p / 100) for p in [50, 90, 99]}) for k, v in sorted(self.samples.items()) if v}}
+
+    def table(self) -> List[str]:
+        data = self.toJSON()
+        lines = ['{:<24} {:>8} {:>10} {:>10}'.format('timer', 'calls', 'total/s', 'mean/ms')]
+        for k, t in data['timers'].items():
+            lines.append('{:<24} {:>8} {:>10.4f} {:>10.3f}'.format(k, t['calls'], t['seconds'], t['seconds'] / t['calls'] * 1000))
+        lines.append('{:<24} {:>8} {:>10} {:>10} {:>10}'.format('sample', 'count', 'p50/ms', 'p90/ms', 'p99/ms'))
+        for k, v in data['samples'].items():
+            lines.append('{:<24} {:>8} {:>10.1f} {:>10.1f} {:>10.1f}'.format(k, v['count'], v['p50'] * 1000, v['p90'] * 1000, v['p99'] * 1000))
+        lines.append('{:<24} {:>8}'.format('counter', 'value'))
+        for k, n in data['counters'].items():
+            lines.append('{:<24} {:>8}'.format(k, n))
+        return lines
+
+stats: Stats = None
+
+def timed(name: str):
+    """
+    Decorator adding the time spent in a function to the timer `name`.
+    """
+    def decorate(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if stats is None:
+                return f(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                stats.time(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
 
 def generateLessonInfo(**info):
     for s in ['count', 'courseID', 'week']:
         assert s in info
     if 'teachers' in info:
         info['teachers'] = '、'.join(info['teachers'])
-    if info['count'] > 1:
+    if 'weeks' in info and info['count'] > 1:
+        infoStr = '第{weeks}周，共{count}次\n课程编号：{courseID}\n教师：{teachers}'
+    elif info['count'] > 1:
         assert 'interval' in info
         if info['interval'] == 1:
             infoStr = '第{week}周开始，每周，共{count}次\n课程编号：{courseID}\n教师：{teachers}'
@@ -60,8 +221,269 @@ def generateLessonInfo(**info):
         infoStr = '第{week}周\n课程编号：{courseID}\n教师：{teachers}'
     return infoStr.format(**info)
 
+def escapeICalText(text: str) -> str:
+    return text.replace('\\N', '\n').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n').replace('\r', '\\n')
+
+def foldICalLine(line: str, limit: int = 75) -> str:
+    """
+    Fold a content line the way icalendar does: a line is broken before the
+    character that would make it reach `limit` octets, never inside a UTF-8
+    sequence and never right after a backslash.
+    """
+    if len(line.encode()) < limit:
+        return line
+    lines = []
+    chars = []
+    count = 0
+    for c in line:
+        n = len(c.encode())
+        if chars and count + n >= limit:
+            if len(chars) > 1 and chars[-1] in '\\^':
+                prefix = chars.pop()
+                lines.append(''.join(chars))
+                chars = [prefix]
+                count = len(prefix.encode())
+            else:
+                lines.append(''.join(chars))
+                chars = []
+                count = 0
+        chars.append(c)
+        count += n
+    lines.append(''.join(chars))
+    return '\r\n '.join(lines)
+
+def formatICalDateTime(d: dt.datetime) -> str:
+    """
+    Return the parameters and value of a DATE-TIME property, e.g.
+    ';TZID=Asia/Shanghai:20200217T080000'.
+    """
+    tzid = getattr(d.tzinfo, 'zone', None) or getattr(d.tzinfo, 'key', None)
+    if d.tzinfo is not None and tzid in (None, 'UTC') and d.utcoffset() == dt.timedelta(0):
+        return ':' + d.strftime('%Y%m%dT%H%M%SZ')
+    if tzid:
+        return ';TZID={}:{}'.format(tzid, d.strftime('%Y%m%dT%H%M%S'))
+    return ':' + d.strftime('%Y%m%dT%H%M%S')
+
+def formatICalDateTimes(ds: List[dt.datetime]) -> str:
+    """
+    Parameters and values of a DATE-TIME list property like EXDATE, all in
+    the time zone of the first one.
+    """
+    return ','.join([formatICalDateTime(ds[0])] + [formatICalDateTime(d).split(':')[-1] for d in ds[1:]])
+
+class ICalEvent:
+    """
+    A VEVENT as plain values. ICalWriter serializes it directly, toComponent()
+    turns it into an icalendar.Event.
+    """
+    __slots__ = ('summary', 'location', 'dtstart', 'dtend', 'uid', 'description', 'rrule', 'dtstamp', 'sequence', 'status', 'rdates', 'exdates')
+
+    def __init__(self, summary: str, location: str, dtstart: dt.datetime, dtend: dt.datetime, uid: str, description: str, rrule: Tuple[int, int] = None, dtstamp: dt.datetime = None, sequence: int = None, status: str = None, rdates: List[dt.datetime] = (), exdates: List[dt.datetime] = ()):
+        """
+        rrule is (interval, count) of a weekly recurrence. rdates are added
+        to it and exdates taken out.
+        """
+        self.summary = summary
+        self.location = location
+        self.dtstart = dtstart
+        self.dtend = dtend
+        self.uid = uid
+        self.description = description
+        self.rrule = rrule
+        self.dtstamp = dtstamp or dt.datetime.now(dt.timezone.utc)
+        self.sequence = sequence
+        self.status = status
+        self.rdates = list(rdates)
+        self.exdates = list(exdates)
+
+    def content(self) -> tuple:
+        """
+        Everything a client displays, i.e. all but UID, DTSTAMP, SEQUENCE and STATUS.
+        """
+        content = (self.summary, self.location, self.dtstart.isoformat(), self.dtend.isoformat(), self.description, self.rrule)
+        if self.rdates or self.exdates:
+            content += (tuple(d.isoformat() for d in self.rdates), tuple(d.isoformat() for d in self.exdates))
+        return content
+
+    def toComponent(self) -> 'icalendar.Event':
+        import icalendar as ics
+        e = ics.Event()
+        e.add('summary', self.summary)
+        e.add('location', self.location)
+        e.add('dtstamp', self.dtstamp)
+        e.add('uid', self.uid)
+        e.add('dtstart', self.dtstart)
+        e.add('dtend', self.dtend)
+        e.add('description', self.description)
+        if self.rrule:
+            e.add('rrule', {'freq': 'weekly', 'interval': self.rrule[0], 'count': self.rrule[1]})
+        if self.rdates:
+            e.add('rdate', self.rdates)
+        if self.exdates:
+            e.add('exdate', self.exdates)
+        if self.sequence is not None:
+            e.add('sequence', self.sequence)
+        if self.status:
+            e.add('status', self.status)
+        return e
+
+    def toICal(self) -> str:
+        # same order as icalendar.Event.canonical_order, then alphabetically
+        lines = ['BEGIN:VEVENT',
+                 'SUMMARY:' + escapeICalText(self.summary),
+                 'DTSTART' + formatICalDateTime(self.dtstart),
+                 'DTEND' + formatICalDateTime(self.dtend),
+                 'DTSTAMP' + formatICalDateTime(self.dtstamp),
+                 'UID:' + escapeICalText(self.uid)]
+        if self.sequence is not None:
+            lines.append('SEQUENCE:{}'.format(self.sequence))
+        if self.rrule:
+            lines.append('RRULE:FREQ=WEEKLY;COUNT={1};INTERVAL={0}'.format(*self.rrule))
+        if self.rdates:
+            lines.append('RDATE' + formatICalDateTimes(self.rdates))
+        if self.exdates:
+            lines.append('EXDATE' + formatICalDateTimes(self.exdates))
+        lines.append('DESCRIPTION:' + escapeICalText(self.description))
+        lines.append('LOCATION:' + escapeICalText(self.location))
+        if self.status:
+            lines.append('STATUS:' + escapeICalText(self.status))
+        lines.append('END:VEVENT')
+        return '\r\n'.join(map(foldICalLine, lines)) + '\r\n'
+
+    def toJSON(self) -> dict:
+        return {'summary': self.summary, 'location': self.location,
+                'dtstart': self.dtstart.replace(tzinfo=None).isoformat(), 'dtend': self.dtend.replace(tzinfo=None).isoformat(),
+                'uid': self.uid, 'description': self.description, 'rrule': self.rrule,
+                'rdates': [d.replace(tzinfo=None).isoformat() for d in self.rdates], 'exdates': [d.replace(tzinfo=None).isoformat() for d in self.exdates]}
+
+    @classmethod
+    def fromJSON(cls, data: dict) -> 'ICalEvent':
+        data = dict(data)
+        for k in ['dtstart', 'dtend']:
+            data[k] = getTimeZone().localize(dt.datetime.fromisoformat(data[k]))
+        for k in ['rdates', 'exdates']:
+            data[k] = [getTimeZone().localize(dt.datetime.fromisoformat(d)) for d in data.get(k, [])]
+        if data['rrule']:
+            data['rrule'] = tuple(data['rrule'])
+        return cls(**data)
+
+class ICalWriter:
+    """
+    Writes a calendar to a text stream event by event instead of building it
+    in memory. The output is the same as icalendar's for the same events.
+    """
+    def __init__(self, fp, termName: str):
+        self.fp = fp
+        self.termName = termName
+        self.count = 0
+
+    def __enter__(self):
+        self.fp.write('BEGIN:VCALENDAR\r\nVERSION:{}\r\n{}\r\n{}\r\n'.format(iCalVersion, foldICalLine('PRODID:' + escapeICalText(programFullName)), foldICalLine('SUMMARY:' + escapeICalText(self.termName))))
+        return self
+
+    def write(self, e: ICalEvent):
+        self.fp.write(e.toICal())
+        self.count += 1
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.fp.write('END:VCALENDAR\r\n')
+
+def weekMaskOf(weeks: Iterable[int]) -> int:
+    mask = 0
+    for w in weeks:
+        mask |= 1 << w
+    return mask
+
+def weeksOfMask(mask: int) -> List[int]:
+    weeks = []
+    while mask:
+        low = mask & -mask
+        weeks.append(low.bit_length() - 1)
+        mask ^= low
+    return weeks
+
+def firstWeekOfMask(mask: int) -> int:
+    return (mask & -mask).bit_length() - 1
+
+def countWeeksOfMask(mask: int) -> int:
+    return bin(mask).count('1')
+
+def formatWeeksOfMask(mask: int) -> str:
+    """
+    E.g. '1-8、10、12-16'.
+    """
+    ranges = []
+    for w in weeksOfMask(mask):
+        if ranges and ranges[-1][1] == w - 1:
+            ranges[-1][1] = w
+        else:
+            ranges.append([w, w])
+    return '、'.join(str(a) if a == b else '{}-{}'.format(a, b) for a, b in ranges)
+
+# rough sizes in bytes of what a recurrence adds to a VEVENT: the RRULE
+# line, an RDATE or EXDATE line and one more date in it
+rruleCost = len('RRULE:FREQ=WEEKLY;COUNT=16;INTERVAL=1\r\n')
+dateListCost = len('EXDATE;TZID=Asia/Shanghai:\r\n')
+dateCost = len('20200217T080000,')
+
+def compactRecurrence(mask: int) -> Tuple[int, int, int, int, int]:
+    """
+    Describe the weeks in mask as a single event: its first week, a weekly
+    RRULE (interval, count; interval 0 for none) and the weeks to take out
+    of it (EXDATE) and to add to it (RDATE) as masks. Of all intervals, the
+    one whose lines are the shortest is chosen.
+    """
+    first = firstWeekOfMask(mask)
+    last = mask.bit_length() - 1
+    listCost = lambda m: dateListCost + dateCost * countWeeksOfMask(m) if m else 0
+    rest = mask & ~(1 << first)
+    best = (listCost(rest), 0, first, 0, 1, 0, rest)
+    for intv in range(1, last - first + 1):
+        # the run ends at its last week that is in mask
+        run = 0
+        for w in range(first, last + 1, intv):
+            if mask >> w & 1:
+                end = w
+            run |= 1 << w
+        run &= (1 << (end + 1)) - 1
+        if run == 1 << first:
+            continue
+        exMask, rMask = run & ~mask, mask & ~run
+        cost = rruleCost + listCost(exMask) + listCost(rMask)
+        best = min(best, (cost, intv, first, intv, (end - first) // intv + 1, exMask, rMask))
+    return best[2:]
+
+internedTeachers = {}
+def internTeachers(teachers: Iterable[str]) -> Tuple[str, ...]:
+    """
+    Return one shared tuple per distinct list of teachers.
+    """
+    teachers = tuple(sys.intern(t) for t in teachers)
+    return internedTeachers.setdefault(teachers, teachers)
+
 class UCourseTime:
+    """
+    One slot of a course: the same weekday, periods, place and teachers in
+    any number of weeks. Weeks are kept as a bitmask (bit w set for week w)
+    and the periods as (first, last), since a schedule may hold many
+    thousands of these.
+    """
+    __slots__ = ('periodRange', 'location', 'teachers', 'extraInfo', 'weekMask', 'dayOfWeek', 'classroom', 'name', 'courseID')
+
     def __init__(self, periods: List[int], name:str, dayOfWeek: int, weeks: List[int], location = '', classroom = '', teachers = [], courseID: str = '', **extraInfo):
+        self.periodRange = self.periodRangeOf(periods)
+        self.location = sys.intern(location)
+        self.teachers = internTeachers(teachers)
+        self.extraInfo = extraInfo or None
+        self.weekMask = weekMaskOf(weeks)
+        self.dayOfWeek = dayOfWeek
+        self.classroom = sys.intern(classroom)
+        self.name = sys.intern(name)
+        self.courseID = sys.intern(courseID)
+
+    @staticmethod
+    def periodRangeOf(periods: List[int]) -> Tuple[int, int]:
         assert len(periods) >= 1
         # check if periods is consecutive
         prev = periods[0]
@@ -69,116 +491,217 @@ class UCourseTime:
             if x - prev != 1:
                 raise Exception('Periods: {} is not consecutive. Please split it!'.format(periods))
             prev = x
-        self.periods = list(periods)
-        self.location = location
-        self.teachers = teachers
-        self.extraInfo = extraInfo
-        self.weeks = sorted(set(weeks))
-        self.dayOfWeek = dayOfWeek
-        self.classroom = classroom
-        self.name = name
-        self.courseID = courseID
-        self.__grouped = False
+        return (periods[0], periods[-1])
+
+    @classmethod
+    def fromRecord(cls, r: 'SlotRecord') -> 'UCourseTime':
+        t = cls.__new__(cls)
+        t.periodRange, t.name, t.dayOfWeek, t.teachers, t.courseID, t.location, t.classroom, t.weekMask = r
+        t.extraInfo = None
+        return t
+
+    @property
+    def periods(self) -> range:
+        return range(self.periodRange[0], self.periodRange[1] + 1)
+
+    @property
+    def weeks(self) -> List[int]:
+        """
+        Sorted week numbers.
+        """
+        return weeksOfMask(self.weekMask)
 
-    def startTime(self):
-        return periodTimes[self.periods[0]][0]
+    def withWeekMask(self, weekMask: int) -> 'UCourseTime':
+        t = copy.copy(self)
+        t.weekMask = weekMask
+        return t
 
-    def endTime(self):
-        return periodTimes[self.periods[-1]][1]
+    def slotKey(self) -> tuple:
+        """
+        Two UCourseTimes of the same course with the same key are the same
+        slot in different weeks.
+        """
+        return (self.dayOfWeek, self.periodRange, self.location, self.teachers)
+
+    def startTime(self) -> dt.time:
+        return periodTimes[self.periodRange[0]][0]
+
+    def endTime(self) -> dt.time:
+        return periodTimes[self.periodRange[1]][1]
 
     def extend(self, weekNumber: int):
-        if weekNumber not in self.weeks:
-            self.weeks.append(weekNumber)
-            self.weeks.sort()
-            self.__grouped = False
+        self.weekMask |= 1 << weekNumber
+
+    def extendWeeks(self, weekNumbers: Iterable[int]):
+        self.weekMask |= weekMaskOf(weekNumbers)
 
     def length(self):
-        return len(self.weeks)
+        return countWeeksOfMask(self.weekMask)
 
     def startDateTime(self, firstDayOfTerm: dt.date, recurrenceNumber: int = 1) -> dt.datetime:
-        return dt.datetime.combine(self.getDate(firstDayOfTerm=firstDayOfTerm, recurrenceNumber=recurrenceNumber), self.startTime())
+        return occurrenceTableOf(firstDayOfTerm).start(self.weeks[recurrenceNumber-1], self.dayOfWeek, self.periodRange[0])
 
     def endDateTime(self, firstDayOfTerm: dt.date, recurrenceNumber: int = 1) -> dt.datetime:
-        return dt.datetime.combine(self.getDate(firstDayOfTerm=firstDayOfTerm, recurrenceNumber=recurrenceNumber), self.endTime())
+        return occurrenceTableOf(firstDayOfTerm).end(self.weeks[recurrenceNumber-1], self.dayOfWeek, self.periodRange[1])
 
     def getDate(self, firstDayOfTerm: dt.date, recurrenceNumber: int = 1) -> dt.date:
-        return firstDayOfTerm + dt.timedelta(days = 7 * (self.weeks[recurrenceNumber-1] - 1) + self.dayOfWeek - 1)
+        return self.weekDate(firstDayOfTerm, self.weeks[recurrenceNumber-1])
+
+    def weekDate(self, firstDayOfTerm: dt.date, week: int) -> dt.date:
+        return firstDayOfTerm + dt.timedelta(days = 7 * (week - 1) + self.dayOfWeek - 1)
+
+    def toCSVRows(self, firstDay: dt.date, subject: str, useLocation: bool = False) -> Iterator[list]:
+        """
+        One row per week, with dates and times looked up in the occurrence
+        table of the term. The other fields are the same for all rows.
+        """
+        table = occurrenceTableOf(firstDay)
+        day, first, last = self.dayOfWeek, self.periodRange[0], self.periodRange[1]
+        location = self.location if useLocation else self.classroom
+        description = '、'.join(self.teachers)
+        mask = self.weekMask
+        while mask:
+            low = mask & -mask
+            mask ^= low
+            week = low.bit_length() - 1
+            start, end = table.start(week, day, first), table.end(week, day, last)
+            yield [subject, start.date(), start.time(), end.date(), end.time(), '', description, location, '']
 
-    def toICalEvents(self, firstDay: dt.date, useLocation: bool = False, group: bool = True, groupmin: int = 3) -> Iterable[ics.Event]:
+    def uid(self, firstDay: dt.date, week: int, interval: int = 0) -> str:
+        """
+        A UID that stays the same across exports as long as the slot (as told
+        apart by slotKey()) and the first week and interval of its run do not
+        change.
+        """
+        key = '/'.join(map(str, [firstDay, self.courseID, self.dayOfWeek, self.periodRange[0], self.periodRange[1], self.location, '、'.join(self.teachers), week, interval]))
+        return str(uuid.uuid5(uidNamespace, key))
+
+    def toICalEvents(self, firstDay: dt.date, useLocation: bool = False, group: bool = True, groupmin: int = 3, recurrence: str = 'greedy') -> Iterable[ICalEvent]:
+        """
+        recurrence 'greedy' makes an event for every run of at least
+        groupmin weeks with a constant interval and one for every other
+        week; 'compact' makes a single event with EXDATE and RDATE as
+        needed (see compactRecurrence).
+        """
         assert group, 'not implemented'
         location = self.location if useLocation else self.classroom
-        def newE():
-            e = ics.Event()
-            e.add('summary', self.name)
-            e.add('location', location)
-            e.add('dtstamp', dt.datetime.today())
-            e.add('uid', uuid.uuid4())
-            return e
-
-        i = 0
-        high = len(self.weeks) - 1
+        table = occurrenceTableOf(firstDay)
+        start = lambda week: table.start(week, self.dayOfWeek, self.periodRange[0])
+        def newE(week, description, interval = 0, rrule = None):
+            return ICalEvent(summary=self.name, location=location,
+                             dtstart=start(week), dtend=table.end(week, self.dayOfWeek, self.periodRange[1]),
+                             uid=self.uid(firstDay, week, interval), description=description, rrule=rrule)
+
+        if recurrence == 'compact' and countWeeksOfMask(self.weekMask) > 1:
+            first, intv, count, exMask, rMask = compactRecurrence(self.weekMask)
+            description = generateLessonInfo(week=first, weeks=formatWeeksOfMask(self.weekMask), count=countWeeksOfMask(self.weekMask), teachers=self.teachers, courseID=self.courseID)
+            e = newE(first, description, intv, (intv, count) if intv else None)
+            e.exdates = [start(w) for w in weeksOfMask(exMask)]
+            e.rdates = [start(w) for w in weeksOfMask(rMask)]
+            yield e
+            return
+
+        rest = self.weekMask
         if group:
-            while high - i >= groupmin - 1:
-                first = self.weeks[i]
-                prev  = self.weeks[i+1]
+            while countWeeksOfMask(rest) >= groupmin:
+                # follow the run starting at the first remaining week for as
+                # long as the next remaining week is `intv` weeks later
+                first = firstWeekOfMask(rest)
+                prev  = firstWeekOfMask(rest & (rest - 1))
                 intv  = prev - first
                 count = 2
-                j = i + 2
-                while j <= high and self.weeks[j] - prev == intv:
+                run   = 1 << first | 1 << prev
+                gap   = (1 << intv) - 1
+                while (rest >> (prev + 1)) & gap == 1 << (intv - 1):
+                    prev += intv
                     count += 1
-                    prev = self.weeks[j]
-                    j += 1
-
-                startDT = self.startDateTime(firstDayOfTerm=firstDay, recurrenceNumber=i+1)
-                endDT = self.endDateTime(firstDayOfTerm=firstDay, recurrenceNumber=i+1)
-                e = newE()
-                e.add('dtstart', startDT)
-                e.add('dtend', endDT)
-                e.add('description', generateLessonInfo(week=first, interval=intv, count=count, teachers=self.teachers, courseID=self.courseID))
+                    run |= 1 << prev
+
+                description = generateLessonInfo(week=first, interval=intv, count=count, teachers=self.teachers, courseID=self.courseID)
                 if count >= groupmin:
-                    e.add('rrule', {'freq': 'weekly', 'interval': intv, 'count': count})
-                    i = j
+                    yield newE(first, description, intv, (intv, count))
+                    rest &= ~run
                 else:
-                    i += 1
-                yield e
-
-        while i <= high:
-            e = newE()
-            e.add('description', generateLessonInfo(week=self.weeks[i], count=1, teachers=self.teachers, location=self.location, classroom=self.classroom, courseID=self.courseID))
-            e.add('dtstart', self.startDateTime(firstDayOfTerm=firstDay, recurrenceNumber=i+1))
-            e.add('dtend', self.endDateTime(firstDayOfTerm=firstDay, recurrenceNumber=i+1))
-            yield e
-            i += 1
+                    yield newE(first, description)
+                    rest &= rest - 1
+
+        while rest:
+            week = firstWeekOfMask(rest)
+            yield newE(week, generateLessonInfo(week=week, count=1, teachers=self.teachers, location=self.location, classroom=self.classroom, courseID=self.courseID))
+            rest &= rest - 1
+
+class SlotRecord(collections.namedtuple('SlotRecord', ['periodRange', 'name', 'dayOfWeek', 'teachers', 'courseID', 'location', 'classroom', 'weekMask'])):
+    """
+    A slot of a course in a single week, as parsed from a response: just
+    the fields UCourseTime needs, with the same names, so that CourseFilter
+    works on both. A UCourseTime is only built for it when it is merged into
+    a course that does not have this slot yet.
+    """
+    __slots__ = ()
+
+    def slotKey(self) -> tuple:
+        return (self.dayOfWeek, self.periodRange, self.location, self.teachers)
+
+splitTeacherCache = {}
+def splitTeachers(teachers: str) -> Tuple[str, ...]:
+    """
+    The interned tuple of teachers in the portal's teacher field; the same
+    strings come back every week, so they are only split once.
+    """
+    result = splitTeacherCache.get(teachers)
+    if result is None:
+        result = internTeachers(teachers.replace('，', ' ').replace(',', ' ').strip().split(' '))
+        splitTeacherCache[teachers] = result
+    return result
 
 class UCourse:
     def __init__(self, courseID: str, name:str, time: List[UCourseTime], teachers = [], **extraInfo):
         self.courseID = courseID
         self.name = name
-        self.time = list(time)
-        self.teachers = teachers
+        self.time = []
+        self.teachers = []
         self.extraInfo = extraInfo
+        self.__slotIndex = {}
+        self.__addTeachers(teachers)
+        for t in time:
+            self.extend(t)
 
-    def extend(self, time: UCourseTime):
-        if time.courseID != self.courseID:
-            raise Exception('Different course ID: {} and {}'.format(self.courseID, time.courseID))
+    def __addTeachers(self, teachers):
         # TODO: Is this the reasonable behavior?
-        for teacher in time.teachers:
+        for teacher in teachers:
             if teacher not in self.teachers:
                 self.teachers.append(teacher)
-        for t in filter(lambda t: all([t.dayOfWeek == time.dayOfWeek,
-                                       t.periods == time.periods,
-                                       t.location == time.location,
-                                       t.teachers == time.teachers]),
-                        self.time):
-            for weekNumber in time.weeks:
-                t.extend(weekNumber)
-            break
+
+    def getSlot(self, key: tuple) -> UCourseTime:
+        return self.__slotIndex.get(key)
+
+    def extend(self, time: UCourseTime):
+        if time.courseID != self.courseID:
+            raise Exception('Different course ID: {} and {}'.format(self.courseID, time.courseID))
+        self.__addTeachers(time.teachers)
+        key = time.slotKey()
+        t = self.__slotIndex.get(key)
+        if t is not None:
+            t.weekMask |= time.weekMask
         else:
+            if isinstance(time, SlotRecord):
+                time = UCourseTime.fromRecord(time)
+            self.__slotIndex[key] = time
             self.time.append(time)
 
-    def toICalEvents(self, firstDay: dt.date, useLocation: bool, group: bool = True) -> Iterable[ics.Event]:
+    def removeWeek(self, weekNumber: int):
+        """
+        Take the week out of every slot; slots left without weeks are dropped.
+        """
+        for t in self.time:
+            t.weekMask &= ~(1 << weekNumber)
+        for t in [t for t in self.time if not t.weekMask]:
+            del self.__slotIndex[t.slotKey()]
+            self.time.remove(t)
+
+    def toICalEvents(self, firstDay: dt.date, useLocation: bool, group: bool = True, recurrence: str = 'greedy') -> Iterable[ICalEvent]:
         for t in self.time:
-            yield from t.toICalEvents(firstDay, useLocation, group)
+            yield from t.toICalEvents(firstDay, useLocation, group, recurrence=recurrence)
 
 class UWeek:
     def __init__(self, weekNumber: int, firstDay: dt.date, lastDay: dt.date, weekName:str, termName: str, coursePeriods):
@@ -195,79 +718,341 @@ class USchedule:
     def __init__(self, termName: str, firstDay: dt.date, courses: List[UCourse] = []):
         self.termName = termName
         self.firstDay = firstDay
-        self.courses = courses
+        self.courses = list(courses)
         self.weeks = []
+        self.__courseIndex = dict((c.courseID, c) for c in self.courses)
+        self.__weekIndex = {}
+        self.__weekNumbers = []
 
     def getCourseByID(self, courseID: str) -> UCourse:
-        for x in self.courses:
-            if x.courseID == courseID:
-                return x
+        return self.__courseIndex.get(courseID)
 
     def hasWeek(self, weekNumber: int):
-        return any(map(lambda x: x.weekNumber == weekNumber, self.weeks))
+        return weekNumber in self.__weekIndex
 
+    def getWeek(self, weekNumber: int) -> UWeek:
+        return self.__weekIndex.get(weekNumber)
+
+    @timed('merge')
     def addWeek(self, week: UWeek):
-        for w in self.weeks:
-            if week.weekNumber == w.weekNumber:
-                raise Exception('Week {} already exists'.format(week.weekNumber))
+        self.__indexWeek(week)
+        i = bisect.bisect(self.__weekNumbers, week.weekNumber)
+        self.__weekNumbers.insert(i, week.weekNumber)
+        self.weeks.insert(i, week)
+        self.__mergeCourses(week)
+
+    def addWeeks(self, weeks: Iterable[UWeek]):
+        """
+        Add many weeks at once; the week list is sorted once at the end.
+        """
+        for week in weeks:
+            self.__indexWeek(week)
+            self.weeks.append(week)
+            self.__mergeCourses(week)
+        self.weeks.sort(key=lambda x: x.weekNumber)
+        self.__weekNumbers = [w.weekNumber for w in self.weeks]
+
+    def removeWeek(self, weekNumber: int):
+        """
+        Take a week out of the schedule, with its course slots; courses
+        left without slots are dropped.
+        """
+        week = self.__weekIndex.pop(weekNumber)
+        i = self.__weekNumbers.index(weekNumber)
+        del self.__weekNumbers[i]
+        del self.weeks[i]
+        for c in self.courses:
+            c.removeWeek(weekNumber)
+        for c in [c for c in self.courses if not c.time]:
+            del self.__courseIndex[c.courseID]
+            self.courses.remove(c)
+        return week
+
+    def updateWeeks(self, weeks: Iterable[UWeek]):
+        """
+        Add weeks, replacing those the schedule already has.
+        """
+        for week in weeks:
+            if self.hasWeek(week.weekNumber):
+                self.removeWeek(week.weekNumber)
+            self.addWeek(week)
+
+    def __indexWeek(self, week: UWeek):
+        if week.weekNumber in self.__weekIndex:
+            raise Exception('Week {} already exists'.format(week.weekNumber))
         if self.termName != week.termName:
             logging.warning('Different termName: {} (schedule), {} (week)'.format(self.termName, week.termName))
-        self.weeks.append(week)
-        self.weeks.sort(key=lambda x: x.weekNumber)
+        self.__weekIndex[week.weekNumber] = week
+
+    def __mergeCourses(self, week: UWeek):
         for c in week.coursePeriods:
-            master = self.getCourseByID(c.courseID)
+            master = self.__courseIndex.get(c.courseID)
             if master:
                 master.extend(c)
             else:
                 logging.warning('发现课程：{}，课程ID：{}'.format(c.name, c.courseID))
-                self.courses.append(UCourse(courseID=c.courseID, name=c.name, time=[c], teachers=c.teachers))
+                master = UCourse(courseID=c.courseID, name=c.name, time=[c], teachers=c.teachers)
+                self.__courseIndex[c.courseID] = master
+                self.courses.append(master)
 
-    def toCSV(self, useLocation: bool, regEx = []) -> str:
+    @timed('toCSV')
+    def toCSV(self, useLocation: bool, courseFilter: 'CourseFilter' = None) -> str:
         csvf = io.StringIO()
-        fieldnames = ['Subject', 'Start Date', 'Start Time', 'End Date', 'End Time', 'All Day Event', 'Description', 'Location', 'Private']
-        writer = csv.DictWriter(csvf, fieldnames)
+        self.writeCSV(csvf, useLocation=useLocation, courseFilter=courseFilter)
+        return csvf.getvalue()
+
+    @timed('writeCSV')
+    def writeCSV(self, fp, useLocation: bool, courseFilter: 'CourseFilter' = None) -> int:
+        """
+        Write one row per occurrence to `fp` as they are generated. Return the
+        number of rows written.
+        """
+        writer = csv.writer(fp)
+        count = 0
+        for row in self.iterCSVRows(useLocation=useLocation, courseFilter=courseFilter):
+            writer.writerow(row)
+            count += 1
+        return count
+
+    def iterCSVRows(self, useLocation: bool, courseFilter: 'CourseFilter' = None) -> Iterator[list]:
+        """
+        Rows in the order of csvFieldNames: courses, then their slots, then
+        the occurrences of each slot.
+        """
+        for c, slots in self.iterCourses(courseFilter):
+            for t in slots:
+                yield from t.toCSVRows(self.firstDay, subject=c.name, useLocation=useLocation)
+
+    def iterCourses(self, courseFilter: 'CourseFilter' = None) -> Iterator[Tuple[UCourse, List[UCourseTime]]]:
+        """
+        Courses with the slots that pass courseFilter, narrowed to the weeks
+        it keeps. Courses left without slots are skipped.
+        """
         for c in self.courses:
-            # regex check
-            skip = False
-            for exp in regEx:
-                if exp[1] == None:
-                    continue
-                assert exp[0]  in ['courseID', 'name']
-                assert exp[-1] in ['fullmatch', 'match', 'search'], 'Unknown method of matching: {}'.format(exp[-1])
-                if getattr(re.compile(exp[1]), exp[-1])(getattr(c, exp[0])) == None:
-                    skip = True
-                    break
-            if skip:
+            if courseFilter is None:
+                yield c, c.time
                 continue
-            # work
+            slots = []
             for t in c.time:
-                for i in range(0, len(t.weeks)):
-                    writer.writerow({'Subject': c.name, 'Start Date': t.getDate(self.firstDay, i), 'Start Time': t.startTime(), 'End Time': t.endTime(), 'Location': t.location if useLocation else t.classroom, 'Description': '{}'.format('、'.join(t.teachers))})
-        return csvf.getvalue()
+                mask = t.weekMask & courseFilter.weekMask(t)
+                if mask == t.weekMask:
+                    slots.append(t)
+                elif mask:
+                    slots.append(t.withWeekMask(mask))
+            if slots:
+                yield c, slots
+            elif stats:
+                stats.count('filteredCourses')
 
-    def toICal(self, useLocation: bool, group: bool = True, regEx = []) -> str:
+    @timed('toICal')
+    def toICal(self, useLocation: bool, group: bool = True, courseFilter: 'CourseFilter' = None, state: 'ExportState' = None, delta: bool = False, recurrence: str = 'greedy') -> str:
+        """
+        With `state`, events carry a SEQUENCE that is bumped whenever their
+        content changes, and with `delta` only new, changed and cancelled
+        events are exported.
+        """
+        import icalendar as ics
         cal = ics.Calendar()
         cal.add('summary', '{}'.format(self.termName))
         cal.add('prodid', programFullName)
         cal.add('version', iCalVersion)
-        for c in self.courses:
-            # regex check
-            skip = False
-            for exp in regEx:
-                if exp[1] == None:
-                    continue
-                assert exp[0]  in ['courseID', 'name']
-                assert exp[-1] in ['fullmatch', 'match', 'search'], 'Unknown method of matching: {}'.format(exp[-1])
-                if getattr(re.compile(exp[1]), exp[-1])(getattr(c, exp[0])) == None:
-                    skip = True
-                    break
-            if skip:
-                continue
-            logging.warning('导出课程“{}”，课程ID：{}'.format(c.name, c.courseID))
-            for e in c.toICalEvents(firstDay=self.firstDay, useLocation=useLocation, group=group):
-                cal.add_component(e)
+        for e in self.iterICalEvents(useLocation=useLocation, group=group, courseFilter=courseFilter, state=state, delta=delta, recurrence=recurrence):
+            cal.add_component(e.toComponent())
         return cal.to_ical().decode()
 
+    @timed('writeICal')
+    def writeICal(self, fp, useLocation: bool, group: bool = True, courseFilter: 'CourseFilter' = None, state: 'ExportState' = None, delta: bool = False, recurrence: str = 'greedy') -> int:
+        """
+        Same as toICal() but writes to `fp` as the courses are visited.
+        Return the number of events written.
+        """
+        with ICalWriter(fp, self.termName) as writer:
+            for e in self.iterICalEvents(useLocation=useLocation, group=group, courseFilter=courseFilter, state=state, delta=delta, recurrence=recurrence):
+                writer.write(e)
+        return writer.count
+
+    def iterICalEvents(self, useLocation: bool, group: bool = True, courseFilter: 'CourseFilter' = None, state: 'ExportState' = None, delta: bool = False, recurrence: str = 'greedy') -> Iterable[ICalEvent]:
+        events = self.iterCourseEvents(useLocation=useLocation, group=group, courseFilter=courseFilter, recurrence=recurrence)
+        if state is not None:
+            events = state.apply(events, delta=delta)
+        return events
+
+    def iterCourseEvents(self, useLocation: bool, group: bool = True, courseFilter: 'CourseFilter' = None, recurrence: str = 'greedy') -> Iterable[ICalEvent]:
+        for c, slots in self.iterCourses(courseFilter):
+            logging.warning('导出课程“{}”，课程ID：{}'.format(c.name, c.courseID))
+            for t in slots:
+                yield from t.toICalEvents(self.firstDay, useLocation, group, recurrence=recurrence)
+
+class UScheduleSet(USchedule):
+    """
+    Several terms exported as one calendar. Every term keeps its own first
+    day and week numbers; the exports visit the terms in order.
+    """
+    def __init__(self, schedules: List[USchedule]):
+        self.schedules = sorted(schedules, key=lambda s: s.firstDay)
+        super().__init__('、'.join(s.termName for s in self.schedules), self.schedules[0].firstDay)
+        self.courses = [c for s in self.schedules for c in s.courses]
+        self.weeks = [w for s in self.schedules for w in s.weeks]
+
+    def iterCSVRows(self, useLocation: bool, courseFilter: 'CourseFilter' = None) -> Iterator[list]:
+        for s in self.schedules:
+            yield from s.iterCSVRows(useLocation=useLocation, courseFilter=courseFilter)
+
+    def iterCourseEvents(self, useLocation: bool, group: bool = True, courseFilter: 'CourseFilter' = None, recurrence: str = 'greedy') -> Iterable[ICalEvent]:
+        for s in self.schedules:
+            yield from s.iterCourseEvents(useLocation=useLocation, group=group, courseFilter=courseFilter, recurrence=recurrence)
+
+class CourseFilter:
+    """
+    Include and exclude rules on course slots, compiled once from the
+    command line and applied both while parsing and while exporting.
+
+    A slot is kept in the weeks where it matches the include rules (all of
+    them, or any of them with mode 'any'; no include rules match
+    everything) and no exclude rule. Rules on weeks match some weeks of a
+    slot, all other rules match all weeks of a slot or none, so the result
+    is a week mask.
+    """
+    fields = ['id', 'name', 'teacher', 'location', 'weekday', 'weeks']
+    allWeeks = -1  # every bit set
+
+    def __init__(self, include: List[tuple] = [], exclude: List[tuple] = [], mode: str = 'all'):
+        """
+        Rules are (field, value) as returned by argFilterRule().
+        """
+        assert mode in ['all', 'any'], 'Unknown filter mode: {}'.format(mode)
+        self.include = [self.compileRule(*r) for r in include]
+        self.exclude = [self.compileRule(*r) for r in exclude]
+        self.mode = mode
+
+    @classmethod
+    def compileRule(cls, field: str, value):
+        """
+        Return a function from a slot to the mask of weeks the rule matches.
+        """
+        allWeeks = cls.allWeeks
+        if field == 'id':
+            return lambda t: allWeeks if value.match(t.courseID) else 0
+        elif field == 'name':
+            return lambda t: allWeeks if value.search(t.name) else 0
+        elif field == 'teacher':
+            return lambda t: allWeeks if any(value.search(x) for x in t.teachers) else 0
+        elif field == 'location':
+            return lambda t: allWeeks if value.search(t.location) or value.search(t.classroom) else 0
+        elif field == 'weekday':
+            return lambda t: allWeeks if t.dayOfWeek in value else 0
+        elif field == 'weeks':
+            mask = 0
+            for lo, hi in value:
+                mask |= -(1 << lo) if hi == float('inf') else (1 << (hi + 1)) - (1 << lo)
+            return lambda t: mask
+        raise Exception('Unknown filter field: {}'.format(field))
+
+    def __bool__(self):
+        return bool(self.include or self.exclude)
+
+    def weekMask(self, t) -> int:
+        """
+        The weeks in which slot t is kept; AND it with t.weekMask.
+        """
+        if not self.include:
+            mask = self.allWeeks
+        elif self.mode == 'all':
+            mask = self.allWeeks
+            for rule in self.include:
+                mask &= rule(t)
+                if not mask:
+                    return 0
+        else:
+            mask = 0
+            for rule in self.include:
+                mask |= rule(t)
+        for rule in self.exclude:
+            if not mask:
+                break
+            mask &= ~rule(t)
+        return mask
+
+    def keeps(self, t, weekNumber: int) -> bool:
+        return bool(self.weekMask(t) >> weekNumber & 1)
+
+    @classmethod
+    def fromOptions(cls, options: dict) -> 'CourseFilter':
+        include = list(options['include'] or [])
+        if options['courseIDRegEx']:
+            include.append(('id', options['courseIDRegEx']))
+        if options['courseNameRegEx']:
+            include.append(('name', options['courseNameRegEx']))
+        return cls(include=include, exclude=options['exclude'] or [], mode=options['filterMode'])
+
+class ExportState:
+    """
+    What the previous export contained: for every event UID, its SEQUENCE, a
+    digest of its content and the event itself (needed to cancel it later).
+    For events that are gone, the last SEQUENCE clients may have seen is
+    kept as a tombstone, so that an event coming back continues above it.
+    Kept in a JSON file between runs.
+    """
+    version = 2
+
+    def __init__(self, path: str):
+        self.path = path
+        self.events = {}
+        self.tombstones = {}
+        self.added = self.changed = self.unchanged = self.cancelled = 0
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        if data.get('version') != self.version:
+            raise Exception('Unsupported state file version: {}'.format(data.get('version')))
+        self.events = data['events']
+        self.tombstones = data.get('tombstones', {})
+
+    @staticmethod
+    def digest(e: ICalEvent) -> str:
+        return hashlib.sha1(json.dumps(e.content(), ensure_ascii=False).encode()).hexdigest()
+
+    def apply(self, events: Iterable[ICalEvent], delta: bool = False) -> Iterable[ICalEvent]:
+        """
+        Number the events against the previous export and update the state.
+        In delta mode unchanged events are dropped and events that are gone
+        are emitted again with STATUS:CANCELLED.
+        """
+        old, self.events = self.events, {}
+        for e in events:
+            digest = self.digest(e)
+            prev = old.pop(e.uid, None)
+            if prev is None:
+                e.sequence = self.tombstones.pop(e.uid, -1) + 1
+                self.added += 1
+            elif prev['digest'] != digest:
+                e.sequence = prev['sequence'] + 1
+                self.changed += 1
+            else:
+                e.sequence = prev['sequence']
+                self.unchanged += 1
+            self.events[e.uid] = {'sequence': e.sequence, 'digest': digest, 'event': e.toJSON()}
+            if delta and prev is not None and prev['digest'] == digest:
+                continue
+            yield e
+        for uid, prev in old.items():
+            if not delta:
+                self.tombstones[uid] = prev['sequence']
+                continue
+            e = ICalEvent.fromJSON(prev['event'])
+            e.sequence = self.tombstones[uid] = prev['sequence'] + 1
+            e.status = 'CANCELLED'
+            self.cancelled += 1
+            yield e
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': self.version, 'events': self.events, 'tombstones': self.tombstones}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
 def argDate(d: str) -> dt.date:
     try:
         return dt.date.fromisoformat(d)
@@ -300,6 +1085,35 @@ def argWeekList(x: str) -> list:
             i += 1
     return lst
 
+def argPositiveInt(x: str) -> int:
+    try:
+        n = int(x)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise argparse.ArgumentTypeError('Not a positive integer: {}'.format(x))
+    return n
+
+def argFilterRule(x: str) -> tuple:
+    # 'teacher=张' -> ('teacher', re.compile('张'))
+    field, sep, value = x.partition('=')
+    if not sep or field not in CourseFilter.fields:
+        raise argparse.ArgumentTypeError('Invalid filter rule: {} (expected FIELD=VALUE, FIELD in {})'.format(x, ', '.join(CourseFilter.fields)))
+    if field == 'weeks':
+        return (field, argWeekList(value))
+    if field == 'weekday':
+        try:
+            days = set(int(d) for d in value.split(','))
+        except ValueError:
+            days = set()
+        if not days or not days <= set(range(1, 8)):
+            raise argparse.ArgumentTypeError('Invalid weekdays: {}'.format(value))
+        return (field, days)
+    try:
+        return (field, re.compile(value))
+    except re.error as e:
+        raise argparse.ArgumentTypeError('Invalid regular expression: {} ({})'.format(value, e))
+
 def argTermName(t: str) -> tuple:
     # 20192 -> (2019, 2)
     msg = 'Invalid term: {}'.format(t)
@@ -312,56 +1126,543 @@ def argTermName(t: str) -> tuple:
     except ValueError:
         raise argparse.ArgumentTypeError(msg)
 
-def fetchClassData(date, eaiSess, uri = defaultClassScheduleURI, cert = None):
-    verify = cert or True
-    response = requests.post(uri, headers={'Cookie': 'eai-sess={}'.format(eaiSess)}, data={'date': date}, verify=verify)
-    response = response.content.decode()
+def argTermList(x: str) -> List[tuple]:
+    # '20191-20202,20221' -> [(2019, 1), (2019, 2), (2020, 1), (2020, 2), (2022, 1)]
+    terms = []
+    for s in x.split(','):
+        first, _, last = s.partition('-')
+        first = argTermName(first)
+        last = argTermName(last) if last else first
+        if last < first:
+            raise argparse.ArgumentTypeError('Invalid term range: {}'.format(s))
+        term = first
+        while term <= last:
+            terms.append(term)
+            term = (term[0], 2) if term[1] == 1 else (term[0] + 1, 1)
+    return sorted(set(terms))
+
+def argDateList(x: str) -> List[dt.date]:
+    return sorted(set(argDate(d) for d in x.split(',')))
+
+class AdaptiveLimiter:
+    """
+    Bounds the number of requests in flight. The limit grows by one after every
+    `limit` fast responses and is halved when a request fails or the latency
+    exceeds `slowFactor` times the fastest one seen so far (AIMD).
+    """
+    def __init__(self, maxJobs: int, slowFactor: float = 3.0):
+        self.maxJobs = max(1, maxJobs)
+        self.limit = self.maxJobs
+        self.slowFactor = slowFactor
+        self.inFlight = 0
+        self.baseline = None
+        self.__credit = 0
+        self.__cond = threading.Condition()
+
+    def acquire(self):
+        with self.__cond:
+            while self.inFlight >= self.limit:
+                self.__cond.wait()
+            self.inFlight += 1
+
+    def release(self, latency: float = None):
+        """
+        Pass the latency of a successful request, or None if it failed.
+        """
+        with self.__cond:
+            self.inFlight -= 1
+            if latency is None:
+                self.__backOff('request failed')
+            else:
+                if self.baseline is None or latency < self.baseline:
+                    self.baseline = latency
+                if latency > self.baseline * self.slowFactor:
+                    self.__backOff('latency {:.3f}s, baseline {:.3f}s'.format(latency, self.baseline))
+                elif self.limit < self.maxJobs:
+                    self.__credit += 1
+                    if self.__credit >= self.limit:
+                        self.__credit = 0
+                        self.limit += 1
+                        logging.debug('Concurrency raised to {}'.format(self.limit))
+            self.__cond.notify_all()
+
+    def __backOff(self, reason: str):
+        self.__credit = 0
+        if self.limit > 1:
+            self.limit = max(1, self.limit // 2)
+            logging.debug('Concurrency lowered to {} ({})'.format(self.limit, reason))
+
+class Transport:
+    """
+    A keep-alive connection pool shared by every request to the portal, so the
+    TCP and TLS handshakes are paid once per connection instead of once per
+    week. Connection errors, timeouts and 5xx responses are retried with
+    jittered exponential backoff, and an AdaptiveLimiter keeps the number of
+    requests in flight within what the portal currently copes with.
+    """
+    def __init__(self, cert = None, poolSize: int = defaultJobs, timeout: float = defaultTimeout, retries: int = defaultRetries, backoff: float = 0.5, gzip: bool = True):
+        self.limiter = AdaptiveLimiter(poolSize)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.requestCount = 0
+        self.retryCount = 0
+        self.cert = cert
+        self.poolSize = poolSize
+        self.gzip = gzip
+        # set up on the first request, runs served from the cache never need requests
+        self.session = self.adapter = None
+        self.__lock = threading.Lock()
+
+    def __connect(self):
+        import requests, requests.adapters
+        with self.__lock:
+            if self.session is not None:
+                return
+            session = requests.Session()
+            session.verify = self.cert or True
+            session.headers['Accept-Encoding'] = 'gzip, deflate' if self.gzip else 'identity'
+            self.adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, self.poolSize))
+            session.mount('https://', self.adapter)
+            session.mount('http://', self.adapter)
+            self.session = session
+
+    def post(self, uri, **kwargs) -> 'requests.Response':
+        import requests
+        if self.session is None:
+            self.__connect()
+        attempt = 0
+        while True:
+            with self.__lock:
+                self.requestCount += 1
+            self.limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = self.session.post(uri, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                # transient, worth retrying
+                error = e
+            except BaseException:
+                # e.g. ContentDecodingError or InvalidURL: retrying would not
+                # help, but the slot must be given back
+                self.limiter.release(None)
+                if stats:
+                    stats.count('httpErrors')
+                raise
+            else:
+                if response.status_code < 500:
+                    latency = time.monotonic() - start
+                    self.limiter.release(latency)
+                    if stats:
+                        stats.sample('httpLatency', latency)
+                    return response
+                error = requests.HTTPError('{} {}'.format(response.status_code, response.reason), response=response)
+            self.limiter.release(None)
+            if stats:
+                stats.count('httpErrors')
+            if attempt >= self.retries:
+                raise error
+            delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            attempt += 1
+            with self.__lock:
+                self.retryCount += 1
+            logging.warning('请求失败（{}），{:.1f}秒后重试'.format(error, delay))
+            time.sleep(delay)
+
+    def connectionStats(self) -> Tuple[int, int]:
+        """
+        Return the number of connections opened and the number of requests
+        that reused an already open connection.
+        """
+        opened = sent = 0
+        if self.adapter is None:
+            return 0, 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                sent += pool.num_requests
+        return opened, sent - opened
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+class ResponseCache:
+    """
+    Compressed on-disk cache of raw portal responses, keyed by (user, week,
+    URI). The user is only stored as a hash of eai-sess. Weeks that are over
+    rarely change and are kept for `pastTTL` seconds, the current and future
+    ones for `currentTTL`. Once the cache grows beyond `maxSize` bytes the
+    least recently used entries are evicted.
+
+    An entry is a file holding its expiry time followed by the zlib
+    compressed response body; its mtime is bumped on every hit and serves as
+    the LRU clock.
+    """
+    suffix = '.kbc'
+
+    def __init__(self, directory: str = None, maxSize: int = defaultCacheSize, pastTTL: float = defaultPastTTL, currentTTL: float = defaultCurrentTTL, offline: bool = False, refresh: bool = False):
+        self.directory = directory or defaultCacheDir()
+        self.maxSize = maxSize
+        self.pastTTL = pastTTL
+        self.currentTTL = currentTTL
+        self.offline = offline
+        self.refresh = refresh
+        self.hits = self.misses = self.stores = self.evictions = 0
+        self.__lock = threading.Lock()
+        self.__size = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, eaiSess, date, uri) -> str:
+        # the portal answers with the whole week, so any day of it (e.g. the
+        # one probeTerm() asks for) finds the entry stored for its Monday
+        if isinstance(date, str):
+            date = dt.date.fromisoformat(date)
+        monday = date - dt.timedelta(days=date.weekday())
+        user = hashlib.sha256(str(eaiSess).encode()).hexdigest()
+        key = hashlib.sha256('\0'.join([user, str(monday), uri]).encode()).hexdigest()
+        return os.path.join(self.directory, key + self.suffix)
+
+    def ttl(self, date) -> float:
+        if isinstance(date, str):
+            date = dt.date.fromisoformat(date)
+        lastDayOfWeek = date + dt.timedelta(days = 6 - date.weekday())
+        return self.pastTTL if lastDayOfWeek < dt.date.today() else self.currentTTL
+
+    def get(self, eaiSess, date, uri) -> bytes:
+        """
+        Return the cached body or None. Expired entries are still returned in
+        offline mode.
+        """
+        if self.refresh:
+            return None
+        path = self.path(eaiSess, date, uri)
+        try:
+            with open(path, 'rb') as f:
+                expires, = struct.unpack('<d', f.read(8))
+                data = f.read()
+            if expires < time.time() and not self.offline:
+                raise FileNotFoundError(path)
+            body = zlib.decompress(data)
+            os.utime(path)
+        except (OSError, struct.error, zlib.error):
+            with self.__lock:
+                self.misses += 1
+            return None
+        with self.__lock:
+            self.hits += 1
+        return body
+
+    def put(self, eaiSess, date, uri, body: bytes):
+        path = self.path(eaiSess, date, uri)
+        data = struct.pack('<d', time.time() + self.ttl(date)) + zlib.compress(body)
+        tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        try:
+            old = os.path.getsize(path)
+        except OSError:
+            old = 0
+        os.replace(tmp, path)
+        with self.__lock:
+            self.stores += 1
+            if self.__size is None:
+                self.__size = self.scanSize()
+            else:
+                self.__size += len(data) - old
+            if self.__size > self.maxSize:
+                self.evict()
+
+    def scanSize(self) -> int:
+        return sum(e.stat().st_size for e in os.scandir(self.directory) if e.name.endswith(self.suffix))
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache is at most 3/4 full.
+        """
+        entries = sorted(((e.stat().st_mtime, e.stat().st_size, e.path) for e in os.scandir(self.directory) if e.name.endswith(self.suffix)))
+        size = sum(e[1] for e in entries)
+        for _, entrySize, path in entries:
+            if size <= self.maxSize * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entrySize
+            self.evictions += 1
+        self.__size = size
+
+def defaultCacheDir() -> str:
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'kbparse')
+
+class TermTable:
+    """
+    First days of terms learned from the server, e.g. {'20192':
+    {'firstDay': '2020-02-17', 'termName': '2019-2020学年下学期', 'stale':
+    False, 'weeks': 18}}. Kept as JSON next to the response cache, so that
+    later runs and other users need not probe the server for them. An entry
+    is marked stale when the server numbers weeks differently, and is probed
+    again on the next run. The number of weeks is known once a run has seen
+    the end of the term.
+    """
+    version = 1
+    fileName = 'terms.json'
+
+    def __init__(self, directory: str = None):
+        self.path = os.path.join(directory or defaultCacheDir(), self.fileName)
+        self.terms = self.load()
+        # terms of a multi-term run are resolved on several threads
+        self.__lock = threading.RLock()
+
+    def load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get('version') != self.version:
+            logging.debug('Ignoring term table of version {}'.format(data.get('version')))
+            return {}
+        return data['terms']
+
+    @staticmethod
+    def key(term: tuple) -> str:
+        return '{}{}'.format(*term)
+
+    def get(self, term: tuple) -> dt.date:
+        entry = self.terms.get(self.key(term))
+        if not entry or entry['stale']:
+            return None
+        return dt.date.fromisoformat(entry['firstDay'])
+
+    def put(self, term: tuple, firstDay: dt.date, termName: str = ''):
+        # other processes may have added terms in the meantime
+        with self.__lock:
+            self.terms = self.load()
+            self.terms[self.key(term)] = {'firstDay': firstDay.isoformat(), 'termName': termName, 'stale': False}
+            self.save()
+
+    def entryOf(self, firstDay: dt.date) -> dict:
+        for entry in self.terms.values():
+            if entry['firstDay'] == firstDay.isoformat() and not entry['stale']:
+                return entry
+        return None
+
+    def length(self, firstDay: dt.date) -> int:
+        """
+        Number of weeks of the term starting on firstDay, or None.
+        """
+        entry = self.entryOf(firstDay)
+        return entry.get('weeks') if entry else None
+
+    def setLength(self, firstDay: dt.date, weeks: int):
+        with self.__lock:
+            self.terms = self.load()
+            entry = self.entryOf(firstDay)
+            if entry and entry.get('weeks') != weeks:
+                entry['weeks'] = weeks
+                self.save()
+
+    def markStale(self, term: tuple):
+        # other processes may have added terms in the meantime
+        with self.__lock:
+            self.terms = self.load()
+            entry = self.terms.get(self.key(term))
+            if entry and not entry['stale']:
+                entry['stale'] = True
+                self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = '{}.{}.{}.tmp'.format(self.path, os.getpid(), threading.get_ident())
+        with self.__lock:
+            with open(tmp, 'w') as f:
+                json.dump({'version': self.version, 'terms': self.terms}, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+
+class ScheduleSnapshot:
+    """
+    Merged schedules of one or more terms in a compact binary file, so that
+    they can be exported again without fetching and parsing. After a magic
+    and a version, the file is zlib-compressed:
+
+        u32 string table length, the strings, UTF-8, separated by NUL
+        u32 integer count, that many little-endian u32
+
+    The integers hold the number of terms and, for each term, its label,
+    name and first day (as an ordinal), its weeks (number, first day, name,
+    term name) and its courses (ID, name, teachers) with their slots
+    (weekday, first and last period, name, course ID, location,
+    classroom, teachers, week mask as u32 words). Strings are indices
+    into the string table, lists are preceded by their length.
+
+    Weeks come back without their slots, which live in the courses.
+    """
+    magic = b'KBSS'
+    version = 1
+
+    @staticmethod
+    @timed('saveSnapshot')
+    def save(path: str, labels: List[str], schedules: List[USchedule]):
+        strings = {}
+        ints = []
+        def string(x: str):
+            ints.append(strings.setdefault(x, len(strings)))
+        def strs(xs: Iterable[str]):
+            xs = list(xs)
+            ints.append(len(xs))
+            for x in xs:
+                string(x)
+
+        ints.append(len(schedules))
+        for label, schedule in zip(labels, schedules):
+            string(label)
+            string(schedule.termName)
+            ints.append(schedule.firstDay.toordinal())
+            ints.append(len(schedule.weeks))
+            for w in schedule.weeks:
+                ints.extend([w.weekNumber, w.firstDay.toordinal()])
+                string(w.weekName)
+                string(w.termName)
+            ints.append(len(schedule.courses))
+            for c in schedule.courses:
+                string(c.courseID)
+                string(c.name)
+                strs(c.teachers)
+                ints.append(len(c.time))
+                for t in c.time:
+                    ints.extend([t.dayOfWeek, t.periodRange[0], t.periodRange[1]])
+                    for x in [t.name, t.courseID, t.location, t.classroom]:
+                        string(x)
+                    strs(t.teachers)
+                    words = []
+                    mask = t.weekMask
+                    while mask:
+                        words.append(mask & 0xffffffff)
+                        mask >>= 32
+                    ints.append(len(words))
+                    ints.extend(words)
+
+        table = '\0'.join(strings).encode()
+        body = struct.pack('<I', len(table)) + table + struct.pack('<I{}I'.format(len(ints)), len(ints), *ints)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(struct.pack('<4sH', ScheduleSnapshot.magic, ScheduleSnapshot.version))
+            f.write(zlib.compress(body))
+        os.replace(tmp, path)
+
+    @staticmethod
+    @timed('loadSnapshot')
+    def load(path: str) -> Tuple[List[str], List[USchedule]]:
+        """
+        Return the labels and the schedules of the terms in the snapshot.
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        header = struct.calcsize('<4sH')
+        magic, version = struct.unpack_from('<4sH', data) if len(data) >= header else (None, None)
+        if magic != ScheduleSnapshot.magic:
+            raise Exception('Not a schedule snapshot: {}'.format(path))
+        if version != ScheduleSnapshot.version:
+            raise Exception('Unsupported snapshot version: {}'.format(version))
+        try:
+            body = zlib.decompress(data[header:])
+            tableLength, = struct.unpack_from('<I', body)
+            strings = [sys.intern(x) for x in body[4:4 + tableLength].decode().split('\0')]
+            count, = struct.unpack_from('<I', body, 4 + tableLength)
+            ints = iter(struct.unpack_from('<{}I'.format(count), body, 8 + tableLength))
+            labels, schedules = [], []
+            string = lambda: strings[next(ints)]
+            strs = lambda: [string() for _ in range(next(ints))]
+            for _ in range(next(ints)):
+                labels.append(string())
+                termName, termFirstDay = string(), dt.date.fromordinal(next(ints))
+                weeks = []
+                for _ in range(next(ints)):
+                    weekNumber, firstDay = next(ints), dt.date.fromordinal(next(ints))
+                    weeks.append(UWeek(weekNumber, firstDay, firstDay + dt.timedelta(days=6), string(), string(), ()))
+                courses = []
+                for _ in range(next(ints)):
+                    courseID, name, teachers = string(), string(), strs()
+                    slots = []
+                    for _ in range(next(ints)):
+                        dayOfWeek, first, last = next(ints), next(ints), next(ints)
+                        slotName, slotCourseID, location, classroom = string(), string(), string(), string()
+                        slotTeachers = internTeachers(strs())
+                        mask = 0
+                        for i in range(next(ints)):
+                            mask |= next(ints) << (32 * i)
+                        slots.append(UCourseTime.fromRecord(((first, last), slotName, dayOfWeek, slotTeachers, slotCourseID, location, classroom, mask)))
+                    courses.append(UCourse(courseID, name, slots, teachers))
+                schedule = USchedule(termName, termFirstDay, courses)
+                schedule.addWeeks(weeks)
+                schedules.append(schedule)
+        except (zlib.error, struct.error, StopIteration, IndexError, UnicodeDecodeError, ValueError):
+            raise Exception('Snapshot is corrupted: {}'.format(path))
+        return labels, schedules
+
+@timed('fetchClassData')
+def fetchClassData(date, eaiSess, uri = defaultClassScheduleURI, cert = None, transport: Transport = None, cache: ResponseCache = None):
+    response = cache.get(eaiSess, date, uri) if cache else None
+    fromCache = response is not None
+    if not fromCache:
+        if cache and cache.offline:
+            raise Exception('Offline mode: no cached response for {}'.format(date))
+        transport = transport or Transport(cert=cert)
+        response = transport.post(uri, headers={'Cookie': 'eai-sess={}'.format(eaiSess)}, data={'date': date}).content
+    if stats:
+        stats.count('bytesFromCache' if fromCache else 'bytesReceived', len(response))
+        start = time.perf_counter()
+    body = response
     try:
-        response = dict(json.loads(response)) # Hint for pylint
-    except json.decoder.JSONDecodeError:
-        logging.debug(response)
+        response = loadJSON(body)
+    except ValueError:
+        logging.debug(body)
         raise Exception('Response as JSON is illegal')
+    if stats:
+        stats.time('decodeJSON', time.perf_counter() - start)
     logging.debug('Got response JSON:')
     logging.debug(response)
-    if any([x not in response for x in ('e', 'm', 'd')]):
+    if not isinstance(response, dict) or any([x not in response for x in ('e', 'm', 'd')]):
         raise Exception('Response JSON appears corrupted')
     if response['e'] != 0:
         logging.error("e != 0 in response JSON. What happened?")
         logging.error("The message reads '{}'".format(response['m']))
         raise Exception('Response JSON appears corrupted')
     courseData = response['d']
+    if cache and not fromCache:
+        cache.put(eaiSess, date, uri, body)
     return courseData
 
-def getFirstDay(eaiSess, term: tuple, uri = defaultClassScheduleURI, cert = None) -> dt.date:
+def probeTerm(eaiSess, term: tuple, uri = defaultClassScheduleURI, cert = None, transport: Transport = None, cache: ResponseCache = None, courseFilter: CourseFilter = None) -> Tuple[dt.date, UWeek]:
+    """
+    Fetch a week in the middle of the term and compute the first day of the
+    term from its week number. The week is returned as well, so that it
+    need not be fetched again; firstDay is 'error' if the server did not say
+    which week it was.
+    """
     assert term[1] in [1, 2]
     if term[1] == 1:
         date = dt.date(year = term[0], month = 10, day = 1)
     else:
         date = dt.date(year = term[0] + 1, month = 3, day = 1)
-    courseData = fetchClassData(date, eaiSess, uri, cert)
-    weekNumber = 0
-    for w in courseData['dateInfo']['name'].strip().split(' '):
-        if (w[0], w[-1]) == ('第', '周'):
-            try:
-                weekNumber = int(w[1:-1])
-                break
-            except ValueError:
-                logging.error('Don\'t know how to interpret week number {}!'.format(w))
-                raise
-    if weekNumber == 0:
+    week = fetchAndParseClassData(date, eaiSess, uri, cert=cert, transport=transport, cache=cache, courseFilter=courseFilter)
+    if week.weekNumber in [0, float('inf')]:
         logging.error('猜测学期首日失败，请使用-d手动指定')
-        logging.debug('Week name returned by server: {}'.format(courseData['dateInfo']['name']))
-        return 'error'
-    firstDay = dt.date.fromisoformat(sorted(courseData['weekdays'])[0]) - oneWeek * (weekNumber - 1)
-    return firstDay
+        logging.debug('Week name returned by server: {}'.format(week.weekName))
+        return 'error', None
+    return week.firstDay - oneWeek * (week.weekNumber - 1), week
 
-def fetchAndParseClassData(date, eaiSess, uri = defaultClassScheduleURI, weekNumber = float('inf'), cert = None) -> UWeek:
+@timed('parseClassData')
+def parseClassData(courseData: dict, weekNumber = float('inf'), courseFilter: CourseFilter = None) -> UWeek:
     """
-    Leave weekNumber empty to use server provided weekName.
+    Leave weekNumber empty to use server provided weekName. Slots rejected
+    by courseFilter are dropped here, before they are merged anywhere.
     """
-    courseData = fetchClassData(date, eaiSess, uri, cert=cert)
-
-    # parsing
     weekName = courseData['dateInfo']['name'].strip()
     termName = ''
     firstDay, lastDay = dt.date.fromisoformat(courseData['weekdays'][0]), dt.date.fromisoformat(courseData['weekdays'][-1])
@@ -374,6 +1675,7 @@ def fetchAndParseClassData(date, eaiSess, uri = defaultClassScheduleURI, weekNum
                 newWeekNumber = int(w[1:-1])
             except ValueError:
                 logging.error('Don\'t know how to interpret week number {}!'.format(w))
+                continue
             if weekNumber != float('inf') and newWeekNumber != weekNumber:
                 logging.warning('本周应为第{}周，但服务器返回了第{}周的数据'.format(weekNumber, newWeekNumber))
             weekNumber = newWeekNumber
@@ -382,13 +1684,119 @@ def fetchAndParseClassData(date, eaiSess, uri = defaultClassScheduleURI, weekNum
 
     # Parsing courses
     courses = []
+    if weekNumber == float('inf'):
+        # a week the server does not number has no place in a week mask
+        logging.debug('No week number in {}, ignoring its courses'.format(weekName))
+        return UWeek(weekNumber=weekNumber, firstDay=firstDay, lastDay=lastDay, weekName=weekName, termName=termName, coursePeriods=courses)
+    weekMask = 1 << weekNumber
+    intern = sys.intern
     for day in courseData['kclist'].values():
         for cc in day.values():
             for c in cc:
-                courses.append(UCourseTime(periods=c['lessArr'], name=c['course_name'], weeks=[weekNumber], dayOfWeek=c['weekday'], teachers=c['teacher'].replace('，', ' ').replace(',', ' ').strip().split(' '), courseID=c['course_id'], location=c['location'], classroom=c['classroom']))
+                t = SlotRecord(UCourseTime.periodRangeOf(c['lessArr']), intern(c['course_name']), c['weekday'], splitTeachers(c['teacher']), intern(c['course_id']), intern(c['location']), intern(c['classroom']), weekMask)
+                if courseFilter and not courseFilter.keeps(t, weekNumber):
+                    logging.debug('Filtered out {} ({}) in week {}'.format(t.name, t.courseID, weekNumber))
+                    if stats:
+                        stats.count('filteredSlots')
+                    continue
+                courses.append(t)
 
     return UWeek(weekNumber=weekNumber, firstDay=firstDay, lastDay=lastDay, weekName=weekName, termName=termName, coursePeriods=courses)
 
+@timed('fetchAndParseClassData')
+def fetchAndParseClassData(date, eaiSess, uri = defaultClassScheduleURI, weekNumber = float('inf'), cert = None, transport: Transport = None, cache: ResponseCache = None, courseFilter: CourseFilter = None) -> UWeek:
+    courseData = fetchClassData(date, eaiSess, uri, cert=cert, transport=transport, cache=cache)
+    return parseClassData(courseData, weekNumber=weekNumber, courseFilter=courseFilter)
+
+def fetchWeek(weekNumber: int, termFirstDay: dt.date, eaiSess, uri = defaultClassScheduleURI, transport: Transport = None, cache: ResponseCache = None, courseFilter: CourseFilter = None) -> UWeek:
+    date = (termFirstDay + oneWeek * (weekNumber - 1)).isoformat()
+    logging.warning('正在获取第{}周的信息'.format(weekNumber))
+    return fetchAndParseClassData(date=date, eaiSess=eaiSess, uri=uri, weekNumber=weekNumber, transport=transport, cache=cache, courseFilter=courseFilter)
+
+def fetchWeeks(weekNumbers: List[int], termFirstDay: dt.date, eaiSess, uri = defaultClassScheduleURI, cert = None, jobs: int = 1, transport: Transport = None, cache: ResponseCache = None, courseFilter: CourseFilter = None, prefetched: dict = None) -> Iterator[Tuple[int, UWeek]]:
+    """
+    Fetch and parse the given weeks on `jobs` threads and yield (weekNumber,
+    UWeek) in the order of weekNumbers, so the result is the same as fetching
+    them one after another. Retrying and backing off are left to the
+    transport. Closing the generator cancels the weeks not fetched yet.
+    Weeks in `prefetched` (weekNumber -> UWeek) are not fetched again.
+    """
+    prefetched = prefetched or {}
+    transport = transport or Transport(cert=cert, poolSize=jobs)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs))
+    pending = collections.deque()
+    todo = iter(weekNumbers)
+    try:
+        while True:
+            # keep at most `jobs` weeks ahead of the one being consumed
+            while len(pending) < jobs:
+                weekNumber = next(todo, None)
+                if weekNumber is None:
+                    break
+                if weekNumber in prefetched:
+                    future = concurrent.futures.Future()
+                    future.set_result(prefetched[weekNumber])
+                else:
+                    future = executor.submit(fetchWeek, weekNumber, termFirstDay, eaiSess, uri, transport=transport, cache=cache, courseFilter=courseFilter)
+                pending.append((weekNumber, future))
+            if not pending:
+                break
+            weekNumber, future = pending.popleft()
+            yield weekNumber, future.result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+def findTermEnd(start: int, maxWeeks: int, termFirstDay: dt.date, eaiSess, uri = defaultClassScheduleURI, cert = None, jobs: int = 1, transport: Transport = None, cache: ResponseCache = None, courseFilter: CourseFilter = None, prefetched: dict = None) -> Tuple[int, dict]:
+    """
+    Find the last week of the term, at most maxWeeks, given that the term
+    contains week `start`. A week belongs to the term if the server names it
+    after the same term as week `start`. The range is narrowed by fetching
+    `jobs` evenly spaced weeks at a time, so about log(maxWeeks) weeks are
+    fetched, most of which are in the term and needed anyway. Return the last
+    week and every week fetched or prefetched (weekNumber -> UWeek).
+    """
+    transport = transport or Transport(cert=cert, poolSize=jobs)
+    known = dict(prefetched or {})
+
+    def fetch(weekNumbers: List[int]):
+        weekNumbers = [n for n in weekNumbers if n not in known]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            for n, week in zip(weekNumbers, executor.map(lambda n: fetchWeek(n, termFirstDay, eaiSess, uri, transport=transport, cache=cache, courseFilter=courseFilter), weekNumbers)):
+                known[n] = week
+
+    fetch([start])
+    termName = known[start].termName
+    inTerm = lambda n: known[n].weekNumber != 0 and known[n].termName == termName
+    # weeks we already have narrow the range for free
+    lo = max([n for n in known if start <= n <= maxWeeks and inTerm(n)], default=start)
+    hi = min([n for n in known if lo < n <= maxWeeks and not inTerm(n)], default=maxWeeks + 1)
+    rounds = 0
+    while hi - lo > 1:
+        k = min(jobs, hi - lo - 1)
+        probes = sorted(set(lo + (hi - lo) * i // (k + 1) for i in range(1, k + 1)))
+        fetch(probes)
+        rounds += 1
+        for n in probes:
+            if not inTerm(n):
+                hi = n
+                break
+            lo = n
+    logging.debug('Week {} is the last one of the term, found in {} rounds'.format(lo, rounds))
+    return lo, known
+
+def openOutput(fileName: str, dryRun: bool = False):
+    """
+    Open the output for streaming writers; '-' is stdout, which is left open.
+    """
+    if dryRun:
+        return open(os.devnull, 'w')
+    if fileName == '-':
+        return contextlib.nullcontext(sys.stdout)
+    return open(fileName, 'w', newline='')
+
 def readOptions():
     parser = argparse.ArgumentParser(description='生成一份本学期的日程表。', prog=programName)
 
@@ -396,8 +1804,9 @@ def readOptions():
     parser.add_argument('-k', '--eai-sess', dest='eaiSess', help='Cookie中eai-sess的值，用于认证')
     # specify at most one of firstDay and termNumber
     gTerm = parser.add_mutually_exclusive_group()
-    gTerm.add_argument('-d', '--first-day', dest='firstDay', help='学期的第一天', type=argDate)
-    gTerm.add_argument('-t', '--term', dest='termName', help='学期，如20192表示2019-2020学年下学期', type=argTermName)
+    gTerm.add_argument('-d', '--first-day', dest='firstDay', help='学期的第一天，多个学期用逗号分隔', type=argDateList)
+    gTerm.add_argument('-t', '--term', dest='termName', help='学期，如20192表示2019-2020学年下学期；也可以是多个学期，如“20191-20202,20221”', type=argTermList)
+    parser.add_argument('--split-terms', dest='splitTerms', action='store_true', help='多个学期时每个学期输出到单独的文件（-o和--state中的{term}替换为学期，没有则加在后缀前），默认合并为一个日历')
     parser.add_argument('-L', '--use-location', dest='useLocation', action='store_true', help='输出“地点”（可能含校区）而非“教室”')
     parser.add_argument('-o', dest='outputFile', help='输出文件名，-代表标准输出')
     parser.add_argument('-f', '--format', dest='outputFormat', choices = ['ics', 'csv'], default='', help='输出格式（默认值：参数中指定的文件后缀>{}）'.format(defaultOutputFormat))
@@ -405,56 +1814,97 @@ def readOptions():
     parser.add_argument('-p', '--dry-run', action='store_true', dest='actDryRun', help='只处理不输出')
     parser.add_argument('-c', '--course-id', dest='courseIDRegEx', help='课程编号（正则，前缀）', type=re.compile)
     parser.add_argument('-n', '--course-name', dest='courseNameRegEx', help='课程名（正则，部分）', type=re.compile)
-    parser.add_argument('-w', '--weeks', dest='weeks', type=argWeekList, help='要生成日程表的周数，例如“2”, “1-”, “1,2-5,3”，默认为%(default)s', default=argWeekList('1-'))
+    parser.add_argument('-i', '--include', action='append', type=argFilterRule, metavar='FIELD=VALUE', help='只保留符合条件的课程，可多次指定。FIELD为{}之一：id（正则，前缀）、name/teacher/location（正则，部分）、weekday（如“1,3”）、weeks（同-w）'.format('/'.join(CourseFilter.fields)))
+    parser.add_argument('-x', '--exclude', action='append', type=argFilterRule, metavar='FIELD=VALUE', help='去掉符合条件的课程，格式同--include，可多次指定')
+    parser.add_argument('--filter-mode', dest='filterMode', choices=['all', 'any'], default='all', help='多个保留条件（包括-c、-n）之间的关系：all为“且”，any为“或”，默认为%(default)s')
+    parser.add_argument('-w', '--weeks', dest='weeks', type=argWeekList, help='要生成日程表的周数，例如“2”, “1-”, “1,2-5,3”，默认为“1-”')
     parser.add_argument('--max-weeks', dest='maxWeeks', type=int, default=24, help='学期所含的最大周数，默认为%(default)s')
     parser.add_argument('--cert', help='连接服务器时使用的证书')
+    parser.add_argument('--recurrence', choices=['greedy', 'compact'], default='greedy', help='iCalendar中重复事件的生成方式：每段固定间隔的周一个事件（greedy），或每个时段只用一个事件，以EXDATE/RDATE表示例外（compact），默认为%(default)s')
+    parser.add_argument('--ics-writer', dest='icsWriter', choices=['icalendar', 'stream'], default='icalendar', help='生成iCalendar的方式：icalendar库，或边生成边写出（stream），两者输出相同，默认为%(default)s')
+    parser.add_argument('--state', dest='statePath', help='记录上次导出内容的文件，用于为事件编号（SEQUENCE）')
+    parser.add_argument('--delta', action='store_true', help='只导出与上次相比新增、修改和取消的事件（需要--state）')
+    parser.add_argument('--snapshot', metavar='FILE', help='把合并好的课表（未经-c、-n、-i、-x筛选）保存为快照')
+    parser.add_argument('--from-snapshot', dest='fromSnapshot', metavar='FILE', help='从快照读取课表，不连接服务器；同时指定-w时获取这些周并合并进去，替换快照中已有的周')
+    parser.add_argument('--batch', dest='batchFile', metavar='FILE', help='批量模式：从文件（-代表标准输入）读取多个用户，每行一个eai-sess，后面可以跟一个名字')
+    parser.add_argument('--batch-output', dest='batchOutput', default='NJUClassSchedule-{name}.{format}', metavar='TEMPLATE', help='批量模式下每个用户的输出文件名，可以使用{name}、{index}和{format}，默认为%(default)s；--state中也可以使用{name}和{index}')
+    parser.add_argument('--processes', type=argPositiveInt, help='批量模式下的进程数，默认为CPU数与用户数中较小的一个')
+    parser.add_argument('--serve', type=argAddress, metavar='[HOST:]PORT', help='以HTTP服务器方式运行，提供-k或--batch中各用户的课表（/名字.ics或/名字.csv，-k的用户名为default），默认只监听127.0.0.1')
+    parser.add_argument('--refresh-interval', dest='refreshInterval', type=float, default=defaultCurrentTTL, help='--serve时重新获取本周及以后各周的间隔（秒），默认为%(default)s')
+    parser.add_argument('--uri', default=defaultClassScheduleURI, help='获取课表的地址，默认为%(default)s；可以指向fakeportal.py用于测试')
+    parser.add_argument('--stats', nargs='?', const='-', metavar='FILE', help='统计各阶段用时、请求延迟、流量等，输出为表格，或指定文件保存为JSON')
+    parser.add_argument('--profile', metavar='FILE', help='用cProfile分析运行过程并保存到文件（只包括主线程，可配合-j 1使用）')
+    parser.add_argument('--timeout', type=float, default=defaultTimeout, help='单个请求的超时时间（秒），默认为%(default)s')
+    parser.add_argument('--retries', type=int, default=defaultRetries, help='请求失败时的重试次数，默认为%(default)s')
+    parser.add_argument('--no-gzip', dest='gzip', action='store_false', help='不请求压缩的响应')
+    parser.add_argument('--cache-dir', dest='cacheDir', help='缓存目录，默认为{}'.format(defaultCacheDir()))
+    parser.add_argument('--cache-size', dest='cacheSize', type=argPositiveInt, default=defaultCacheSize // 1024 // 1024, help='缓存大小上限（MiB），默认为%(default)s')
+    parser.add_argument('--no-cache', dest='useCache', action='store_false', help='不读写缓存')
+    gCache = parser.add_mutually_exclusive_group()
+    gCache.add_argument('--offline', action='store_true', help='只使用缓存，不连接服务器')
+    gCache.add_argument('--refresh', action='store_true', help='忽略已有的缓存，重新获取并写入缓存')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=argPositiveInt, default=defaultJobs, help='同时进行的请求数上限，出错或服务器变慢时自动减少，默认为%(default)s')
 
     options = vars(parser.parse_args())
     return options
 
-def main():
-    options = readOptions()
-    eaiSess    = options['eaiSess']
-    #termLength = options['termLength']
-    outputFormat = options['outputFormat'].lower()
-    useLocation = options['useLocation']
-    actDryRun   = options['actDryRun']
-    logging.getLogger().setLevel(options['logLevel'].upper())
-    weeks = options['weeks']
-    maxWeeks = options['maxWeeks']
-    courseIDRegEx = options['courseIDRegEx']
-    courseNameRegEx = options['courseNameRegEx']
-    cert = options['cert']
-
-    if not eaiSess:
-        logging.warning('在下面输入eai-sess的值。')
-        logging.warning('这个值可以在登录“南京大学信息门户”（https://wx.nju.edu.cn/homepage/wap/default/home）后在cookies中找到。')
-        eaiSess = input()
-
-    # store first day of term in firstDay
+def guessTerm(today: dt.date = None) -> tuple:
+    today = today or dt.date.today()
+    if today.month in [1, 2, 3, 4, 5, 6]:
+        # Spring
+        return (today.year - 1, 2)
+    else:
+        # Fall
+        return (today.year, 1)
+
+def makeTransport(options: dict) -> Transport:
+    return Transport(cert=options['cert'], poolSize=options['jobs'], timeout=options['timeout'], retries=options['retries'], gzip=options['gzip'])
+
+def makeCache(options: dict) -> ResponseCache:
+    if not options['useCache']:
+        return None
+    return ResponseCache(options['cacheDir'], maxSize=options['cacheSize'] * 1024 * 1024, offline=options['offline'], refresh=options['refresh'])
+
+def makeTermTable(options: dict) -> TermTable:
+    return TermTable(options['cacheDir']) if options['useCache'] else None
+
+def resolveFirstDay(options: dict, eaiSess, transport: Transport, cache: ResponseCache = None, termTable: TermTable = None, courseFilter: CourseFilter = None) -> Tuple[dt.date, tuple, dict]:
+    """
+    The first day of the term from -d, the term table, or asked from the
+    server for -t or the current term. Return (firstDay, tableTerm,
+    prefetched): tableTerm is the term if firstDay was read from the term
+    table and None otherwise, prefetched holds the week fetched while
+    asking, if any. firstDay is 'error' if the server's answer makes no
+    sense.
+    """
     if options['firstDay']:
         firstDay = options['firstDay']
         logging.warning('已指定学期首日：{}'.format(firstDay))
+        return firstDay, None, {}
+    if not options['termName']:
+        optTerm = guessTerm()
+        logging.warning('未指定学期，使用{}'.format(''.join(map(str, optTerm))))
     else:
-        if not options['termName']:
-            optToday = dt.date.today()
-            if optToday.month in [1, 2, 3, 4, 5, 6]:
-                # Spring
-                optTerm = (optToday.year - 1, 2)
-            elif optToday.month in [7, 8, 9, 10, 11, 12]:
-                # Fall
-                optTerm = (optToday.year, 1)
-            logging.warning('未指定学期，使用{}'.format(''.join(map(str, optTerm))))
-        else:
-            optTerm = options['termName']
-        firstDay = getFirstDay(eaiSess, optTerm, cert=cert)
-        if firstDay == 'error':
-            return 1
-        logging.warning('未指定学期首日，猜测为{}'.format(firstDay))
+        optTerm = options['termName']
+    if termTable and not options['refresh']:
+        firstDay = termTable.get(optTerm)
+        if firstDay:
+            logging.warning('使用已保存的学期首日：{}'.format(firstDay))
+            return firstDay, optTerm, {}
+    firstDay, week = probeTerm(eaiSess, optTerm, options['uri'], transport=transport, cache=cache, courseFilter=courseFilter)
+    if firstDay == 'error':
+        return firstDay, None, {}
+    logging.warning('未指定学期首日，猜测为{}'.format(firstDay))
+    if termTable:
+        termTable.put(optTerm, firstDay, week.termName)
+    return firstDay, None, {week.weekNumber: week}
 
-    # determine output file name and format (and suffix)
-    if options['outputFile'] not in [None, '-']:
-        outputFileName = options['outputFile']
+def resolveOutput(outputFile: str, outputFormat: str) -> Tuple[str, str, str]:
+    """
+    Return the output file name, format and file name suffix.
+    """
+    if outputFile not in [None, '-']:
+        outputFileName = outputFile
         outputFileSuffix = '' if outputFileName.endswith('.') or '.' not in outputFileName else outputFileName.split('.')[-1]
         if not outputFormat:
             if outputFileSuffix in ['csv', 'ics']:
@@ -463,81 +1913,710 @@ def main():
             else:
                 logging.warning('使用默认输出格式{}'.format(defaultOutputFormat))
                 outputFormat = defaultOutputFormat
+    elif outputFile == '-':
+        outputFileName = '-'
+        outputFileSuffix = ''
+        if not outputFormat:
+            outputFormat = defaultOutputFormat
     else:
-        if options['outputFile'] == '-':
-            outputFileName = '-'
-            outputFileSuffix = ''
-            if not outputFormat:
-                outputFormat = defaultOutputFormat
-        elif options['outputFile'] == None:
-            if not outputFormat:
-                logging.warning('未指定输出格式，使用默认格式{}'.format(defaultOutputFormat))
-                outputFormat = defaultOutputFormat
-            outputFileSuffix = outputFormat
-            outputFileName = 'NJUClassSchedule-{}.{}'.format(dt.datetime.today().isoformat(), outputFormat)
+        if not outputFormat:
+            logging.warning('未指定输出格式，使用默认格式{}'.format(defaultOutputFormat))
+            outputFormat = defaultOutputFormat
+        outputFileSuffix = outputFormat
+        outputFileName = 'NJUClassSchedule-{}.{}'.format(dt.datetime.today().isoformat(), outputFormat)
+    return outputFileName, outputFormat, outputFileSuffix
 
+def fetchSchedule(eaiSess, termFirstDay: dt.date, weeks: list, maxWeeks: int, uri = defaultClassScheduleURI, jobs: int = 1, transport: Transport = None, cache: ResponseCache = None, courseFilter: CourseFilter = None, prefetched: dict = None, tableTerm: tuple = None, termTable: TermTable = None) -> USchedule:
+    """
+    Fetch the weeks in `weeks` (as returned by argWeekList) and merge them
+    into a schedule. If termFirstDay was read from termTable (for
+    tableTerm) and the server numbers a week of the term differently, the
+    entry is marked stale and None is returned.
+
+    The end of an open-ended range is taken from the term length remembered
+    in termTable, or found with findTermEnd(), after which all weeks in the
+    term are fetched at once.
+    """
     logging.warning('正在生成这些周的日程表：{}'.format(weeks))
 
     termName = ''
-    termFirstDay = firstDay
     schedule = USchedule(termName, termFirstDay)
 
-    processed = {}
+    # if the range is open-ended (only the last one can be, after merging)
+    # it ends with the term
+    openEnded = weeks[-1][1] == float('inf')
+    if openEnded and weeks[-1][0] <= maxWeeks:
+        start = weeks[-1][0]
+        lastWeek = termTable.length(termFirstDay) if termTable and not (cache and cache.refresh) else None
+        if lastWeek:
+            lastWeek = min(lastWeek, maxWeeks)
+            logging.warning('使用已保存的学期长度：{}周'.format(lastWeek))
+        else:
+            before = set(prefetched or {})
+            lastWeek, prefetched = findTermEnd(start, maxWeeks, termFirstDay, eaiSess, uri, jobs=jobs, transport=transport, cache=cache, courseFilter=courseFilter, prefetched=prefetched)
+            wasted = sum(1 for n in prefetched if n > lastWeek and n not in before)
+            # walking week by week costs a window of `jobs` weeks past the end
+            walked = min(jobs, maxWeeks - lastWeek)
+            logging.warning('本学期共有{}周，确定学期结束多用了{}个请求，逐周获取需要{}个，节省{}个'.format(lastWeek, wasted, walked, walked - wasted))
+            if termTable and lastWeek < maxWeeks:
+                termTable.setLength(termFirstDay, lastWeek)
+        weeks = weeks[:-1] + [(start, lastWeek)]
+    weekNumbers = []
     for ww in weeks:
-        # if ww[1] is infinity continue processing until it's likely that the current term has ended
-        weekNumber = ww[0]-1
+        weekNumbers.extend(range(ww[0], int(min(ww[1], maxWeeks)) + 1))
 
-        while weekNumber < min(ww[1], maxWeeks):
-            weekNumber += 1
-            if weekNumber in processed:
-                logging.warning('已经处理过，跳过第{}周'.format(weekNumber))
-                continue
+    fetcher = fetchWeeks(weekNumbers, termFirstDay, eaiSess, uri, jobs=jobs, transport=transport, cache=cache, courseFilter=courseFilter, prefetched=prefetched)
+    for weekNumber, weekData in fetcher:
+        if not termName:
+            schedule.termName = termName = weekData.termName
+            logging.warning('本学期是{}'.format(termName))
+        elif weekData.weekNumber == 0 or weekData.termName != termName:
+            logging.debug('Reached week {}, probably the next term.'.format(weekData.weekName))
+            if openEnded and weekNumber >= weeks[-1][0]:
+                # the remembered length was too long
+                logging.warning('本学期共有{}周'.format(weekNumber - 1))
+                if termTable:
+                    termTable.setLength(termFirstDay, weekNumber - 1)
+                fetcher.close()
+                break
             else:
-                logging.warning('正在获取第{}周的信息'.format(weekNumber))
-            firstDay = termFirstDay + oneWeek * (weekNumber - 1)
-            logging.debug('Fetching courses for week {}'.format(weekNumber))
-            weekData = fetchAndParseClassData(date=firstDay.isoformat(), eaiSess=eaiSess, weekNumber=weekNumber, cert=cert)
-
-            if not termName:
-                schedule.termName = termName = weekData.termName
-                logging.warning('本学期是{}'.format(termName))
-            elif weekData.weekNumber == 0 or weekData.termName != termName:
-                logging.debug('Reached week {}, probably the next term.'.format(weekData.weekName))
-                if ww[1] == float('inf'):
-                    logging.warning('本学期共有{}周'.format(weekNumber - 1))
-                    break
-                else:
-                    logging.warning('第{week}周时本学期已经结束'.format(week=weekNumber))
-            logging.debug('It is {} (from {} to {}) now'.format(weekData.weekName, weekData.firstDay, weekData.lastDay))
-            if not weekData.coursePeriods:
-                logging.warning('本周没有课程，可以休息 :-)')
+                logging.warning('第{week}周时本学期已经结束'.format(week=weekNumber))
+        if weekData.weekNumber != weekNumber and weekData.termName == termName and tableTerm and termTable:
+            logging.warning('已保存的学期首日与服务器的周数不符')
+            termTable.markStale(tableTerm)
+            fetcher.close()
+            return None
+        logging.debug('It is {} (from {} to {}) now'.format(weekData.weekName, weekData.firstDay, weekData.lastDay))
+        if not weekData.coursePeriods:
+            logging.warning('本周没有课程，可以休息 :-)')
 
-            schedule.addWeek(weekData)
+        schedule.addWeek(weekData)
+    return schedule
 
+def fetchTermSchedule(options: dict, eaiSess, transport: Transport, cache: ResponseCache = None, termTable: TermTable = None, courseFilter: CourseFilter = None, resolved: tuple = None) -> USchedule:
+    """
+    Resolve the first day of the term (unless `resolved` already holds what
+    resolveFirstDay() returned) and fetch the schedule, asking the server
+    again if the first day in the term table turns out to be stale. Return
+    'error' if the first day cannot be found.
+    """
+    while True:
+        firstDay, tableTerm, prefetched = resolved or resolveFirstDay(options, eaiSess, transport=transport, cache=cache, termTable=termTable, courseFilter=courseFilter)
+        resolved = None
+        if firstDay == 'error':
+            return firstDay
+        schedule = fetchSchedule(eaiSess, firstDay, options['weeks'], options['maxWeeks'], options['uri'], jobs=options['jobs'], transport=transport, cache=cache, courseFilter=courseFilter, prefetched=prefetched, tableTerm=tableTerm, termTable=termTable)
+        if schedule is not None:
+            return schedule
 
-    # warn if file format and suffix do not match
-    if outputFormat != outputFileSuffix and outputFileSuffix in supportedFileFormats:
-        logging.warning('导出为{}格式，但输出文件名后缀为{}'.format(outputFormat, outputFileSuffix))
+def splitTerms(options: dict) -> List[dict]:
+    """
+    A copy of the options for each term given with -t or -d, holding that
+    term alone; a single copy if neither is given.
+    """
+    if options['firstDay']:
+        return [dict(options, firstDay=d, termName=None) for d in options['firstDay']]
+    if options['termName']:
+        return [dict(options, termName=t, firstDay=None) for t in options['termName']]
+    return [dict(options)]
+
+def termLabel(options: dict) -> str:
+    # '20192', or the first day for -d
+    if options['firstDay']:
+        return options['firstDay'].isoformat()
+    return TermTable.key(options['termName'] or guessTerm())
 
-    regEx = [('courseID', courseIDRegEx, 'match'), ('name', courseNameRegEx, 'search')]
+def termFileName(fileName: str, term: str) -> str:
+    # 'out/{term}.ics' -> 'out/20192.ics', 'out.ics' -> 'out-20192.ics'
+    if '{term}' in fileName:
+        return fileName.replace('{term}', term)
+    root, ext = os.path.splitext(fileName)
+    return '{}-{}{}'.format(root, term, ext)
+
+def fetchTermSchedules(termOptions: List[dict], eaiSess, transport: Transport, cache: ResponseCache = None, termTable: TermTable = None, courseFilter: CourseFilter = None) -> List[USchedule]:
+    """
+    fetchTermSchedule() for every term at the same time. The terms share the
+    transport, whose limiter bounds the requests in flight over all of them,
+    so weeks of all terms are fetched as fast as -j allows. Return 'error'
+    if the first day of a term cannot be found.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(termOptions)) as executor:
+        schedules = list(executor.map(lambda o: fetchTermSchedule(o, eaiSess, transport, cache=cache, termTable=termTable, courseFilter=courseFilter), termOptions))
+    for o, schedule in zip(termOptions, schedules):
+        if schedule == 'error':
+            logging.error('获取{}学期的课表失败'.format(termLabel(o)))
+            return 'error'
+    return schedules
+
+def writeSchedule(schedule: USchedule, outputFileName: str, outputFormat: str, options: dict, courseFilter: CourseFilter = None, statePath: str = None) -> int:
+    """
+    Export the schedule in outputFormat; '-' is stdout. Return the number of
+    events or rows written.
+    """
+    useLocation = options['useLocation']
+    actDryRun = options['actDryRun']
+    state = None
+    if statePath and outputFormat == 'ics':
+        state = ExportState(statePath)
+    outputData = None
+    count = 0
     if outputFormat == 'csv':
         logging.warning('生成CSV……')
-        outputData = schedule.toCSV(useLocation=useLocation, regEx = regEx)
+        with openOutput(outputFileName, actDryRun) as outputFile:
+            count = schedule.writeCSV(outputFile, useLocation=useLocation, courseFilter=courseFilter)
+    elif outputFormat == 'ics' and options['icsWriter'] == 'stream':
+        logging.warning('生成iCalendar……')
+        with openOutput(outputFileName, actDryRun) as outputFile:
+            count = schedule.writeICal(outputFile, useLocation=useLocation, courseFilter=courseFilter, state=state, delta=options['delta'], recurrence=options['recurrence'])
     elif outputFormat == 'ics':
         logging.warning('生成iCalendar……')
-        outputData = schedule.toICal(useLocation=useLocation, regEx = regEx)
+        outputData = schedule.toICal(useLocation=useLocation, courseFilter=courseFilter, state=state, delta=options['delta'], recurrence=options['recurrence'])
+        count = outputData.count('\r\nBEGIN:VEVENT\r\n')
+    if stats:
+        stats.count('csvRows' if outputFormat == 'csv' else 'events', count)
+    if state is not None:
+        logging.warning('新增{}个事件，修改{}个，未变{}个，取消{}个'.format(state.added, state.changed, state.unchanged, state.cancelled))
     if not actDryRun:
-        if outputFileName == '-':
+        if outputData is None:
+            pass
+        elif outputFileName == '-':
             print(outputData, end='')
         else:
             outputFile = open(outputFileName, 'w')
             outputFile.write(outputData)
             outputFile.close()
+        if outputFileName != '-':
             logging.warning('已保存到{}。'.format(outputFileName))
+        if state is not None:
+            state.save()
     else:
         logging.warning('没有输出。')
+    return count
+
+def readBatch(fileName: str) -> List[Tuple[str, str]]:
+    """
+    One user per line: eai-sess, optionally followed by a name used in output
+    file names. Blank lines and lines starting with # are ignored.
+    """
+    f = sys.stdin if fileName == '-' else open(fileName)
+    try:
+        users = []
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            users.append((fields[0], fields[1] if len(fields) > 1 else 'user{}'.format(len(users) + 1)))
+        return users
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+# per-process state of batch workers, set up by initBatchWorker()
+batchWorker = {}
+
+def initBatchWorker(options: dict):
+    logging.getLogger().setLevel(options['logLevel'].upper())
+    if options['stats']:
+        global stats
+        stats = Stats()
+    batchWorker['options'] = options
+    batchWorker['transport'] = makeTransport(options)
+    batchWorker['cache'] = makeCache(options)
+    batchWorker['courseFilter'] = CourseFilter.fromOptions(options)
+    batchWorker['termTable'] = makeTermTable(options)
+
+def exportBatchUser(task: tuple) -> dict:
+    """
+    Fetch and export one user of a batch in a worker process. Never raises;
+    failures are reported in the result.
+    """
+    global stats
+    index, name, eaiSess, resolved = task
+    if stats:
+        # only this user's, the parent adds them up
+        stats = Stats()
+    options = batchWorker['options']
+    transport = batchWorker['transport']
+    result = {'index': index, 'name': name, 'ok': False, 'error': '', 'weeks': 0, 'requests': 0, 'count': 0, 'fetchTime': 0.0, 'exportTime': 0.0}
+    requests0 = transport.requestCount
+    start = time.monotonic()
+    try:
+        fields = {'name': name, 'index': index}
+        outputFileName, outputFormat, _ = resolveOutput(options['batchOutput'].format(format=options['outputFormat'] or defaultOutputFormat, **fields), options['outputFormat'])
+        schedule = fetchTermSchedule(options, eaiSess, transport, cache=batchWorker['cache'], termTable=batchWorker['termTable'], courseFilter=batchWorker['courseFilter'], resolved=resolved)
+        if schedule == 'error':
+            raise Exception('Cannot find the first day of the term')
+        result['weeks'] = len(schedule.weeks)
+        result['fetchTime'] = time.monotonic() - start
+        dirName = os.path.dirname(outputFileName)
+        if dirName and not options['actDryRun']:
+            os.makedirs(dirName, exist_ok=True)
+        statePath = options['statePath'].format(**fields) if options['statePath'] else None
+        result['count'] = writeSchedule(schedule, outputFileName, outputFormat, options, courseFilter=batchWorker['courseFilter'], statePath=statePath)
+        result['exportTime'] = time.monotonic() - start - result['fetchTime']
+        result['ok'] = True
+    except Exception as e:
+        logging.debug('User {} failed'.format(name), exc_info=True)
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    result['requests'] = transport.requestCount - requests0
+    if stats:
+        stats.count('httpRequests', result['requests'])
+        result['stats'] = stats.raw()
+    return result
+
+def runBatch(options: dict) -> int:
+    """
+    Export the schedules of all users listed in options['batchFile'] on a
+    pool of processes. The first day of the term is resolved once, with the
+    first user's session, and shared by everyone.
+    """
+    users = readBatch(options['batchFile'])
+    if not users:
+        logging.error('批量文件中没有用户')
+        return 1
+    if options['outputFile']:
+        logging.warning('批量模式下忽略-o，使用--batch-output')
+    # every user needs files of their own, or the workers overwrite each other
+    names = [name for _, name in users]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        logging.error('批量文件中的名字重复：{}'.format('、'.join(duplicates)))
+        return 1
+    if len(users) > 1:
+        for option, template in [('--batch-output', options['batchOutput']), ('--state', options['statePath'])]:
+            if template and '{name}' not in template and '{index}' not in template:
+                logging.error('{}中必须包含{{name}}或{{index}}'.format(option))
+                return 1
+    start = time.monotonic()
+    transport = makeTransport(options)
+    firstDay, tableTerm, prefetched = resolveFirstDay(options, users[0][0], transport=transport, cache=makeCache(options), termTable=makeTermTable(options), courseFilter=CourseFilter.fromOptions(options))
+    transport.close()
+    if firstDay == 'error':
+        return 1
+
+    processes = options['processes'] or min(len(users), os.cpu_count() or 1)
+    logging.warning('共{}个用户，使用{}个进程'.format(len(users), processes))
+    # the week fetched while asking for the first day belongs to the first user
+    tasks = [(i + 1, name, eaiSess, (firstDay, tableTerm, prefetched if i == 0 else {})) for i, (eaiSess, name) in enumerate(users)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=initBatchWorker, initargs=(options,)) as executor:
+        results = list(executor.map(exportBatchUser, tasks))
+    wallTime = time.monotonic() - start
+    if stats:
+        for r in results:
+            stats.merge(r['stats'])
+
+    logging.warning('{:>4} {:<16} {:>6} {:>6} {:>8} {:>9} {:>9}  {}'.format('#', 'name', 'weeks', 'reqs', 'items', 'fetch/s', 'export/s', 'status'))
+    for r in results:
+        logging.warning('{index:>4} {name:<16} {weeks:>6} {requests:>6} {count:>8} {fetchTime:>9.2f} {exportTime:>9.2f}  {0}'.format('ok' if r['ok'] else r['error'], **r))
+    failed = sum(1 for r in results if not r['ok'])
+    weeks = sum(r['weeks'] for r in results)
+    logging.warning('完成{}个用户，失败{}个，用时{:.2f}秒（{:.2f}用户/秒，{:.1f}周/秒）'.format(len(results) - failed, failed, wallTime, len(results) / wallTime, weeks / wallTime))
+    return 1 if failed else 0
+
+class ServedUser:
+    """
+    What the server keeps for one user: the weeks fetched so far, the
+    schedule merged from them and the exports rendered from it, keyed by
+    format and query. Any change to the weeks rebuilds the schedule and
+    drops the renders. Since every query string makes a render of its own,
+    only the maxRenders most recently used ones are kept.
+    """
+    maxRenders = 16
+
+    def __init__(self, name: str, eaiSess):
+        self.name = name
+        self.eaiSess = eaiSess
+        self.weeks = {}
+        self.schedule = None
+        self.lastModified = 0
+        self.renders = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def update(self, firstDay: dt.date, termName: str, weeks: Iterable[UWeek]) -> bool:
+        """
+        Store the weeks and rebuild the schedule if any of them changed.
+        Return whether something changed.
+        """
+        changed = [w for w in weeks if w.weekNumber not in self.weeks or self.weeks[w.weekNumber].coursePeriods != w.coursePeriods or self.weeks[w.weekNumber].weekName != w.weekName]
+        if not changed and self.schedule is not None:
+            return False
+        allWeeks = dict(self.weeks)
+        allWeeks.update((w.weekNumber, w) for w in changed)
+        # records are immutable, so merging them again gives fresh slots
+        schedule = USchedule(termName, firstDay)
+        schedule.addWeeks(allWeeks.values())
+        self.replace(schedule, allWeeks)
+        return True
+
+    def replace(self, schedule: 'USchedule', weeks: dict):
+        with self.lock:
+            self.weeks = weeks
+            self.schedule = schedule
+            self.lastModified = int(time.time())
+            self.renders = collections.OrderedDict()
+
+class ScheduleServer:
+    """
+    Serves the schedules of a set of users over HTTP as /NAME.ics and
+    /NAME.csv, optionally narrowed with ?include=FIELD=VALUE,
+    ?exclude=FIELD=VALUE, ?mode=any and ?recurrence=compact. Renders are
+    kept until the schedule changes, and answered with ETag and
+    Last-Modified so that polling clients mostly get 304. Current and
+    future weeks are fetched again every refreshInterval seconds in the
+    background; polls never reach the portal.
+    """
+    contentTypes = {'ics': 'text/calendar; charset=utf-8', 'csv': 'text/csv; charset=utf-8'}
+
+    def __init__(self, options: dict, users: List[Tuple[str, str]], refreshInterval: float = defaultCurrentTTL):
+        self.options = options
+        self.transport = makeTransport(options)
+        self.cache = makeCache(options)
+        # refreshes must ask the portal, but still leave the answers for
+        # later runs
+        self.refreshCache = makeCache(dict(options, refresh=not options['offline']))
+        self.termTable = makeTermTable(options)
+        self.courseFilter = CourseFilter.fromOptions(options)
+        self.refreshInterval = refreshInterval
+        self.users = dict((name, ServedUser(name, eaiSess)) for eaiSess, name in users)
+        self.stopped = threading.Event()
+
+    def load(self, user: ServedUser, resolved: tuple = None):
+        schedule = fetchTermSchedule(self.options, user.eaiSess, self.transport, cache=self.cache, termTable=self.termTable, courseFilter=self.courseFilter, resolved=resolved)
+        if schedule == 'error':
+            raise Exception('Cannot find the first day of the term')
+        user.replace(schedule, dict((w.weekNumber, w) for w in schedule.weeks))
+
+    def refresh(self, user: ServedUser) -> bool:
+        """
+        Fetch the weeks of the user that are not over yet again.
+        """
+        schedule = user.schedule
+        today = dt.date.today()
+        weekNumbers = [n for n, w in sorted(user.weeks.items()) if w.lastDay >= today]
+        if not weekNumbers:
+            return False
+        fetched = [w for _, w in fetchWeeks(weekNumbers, schedule.firstDay, user.eaiSess, self.options['uri'], jobs=self.options['jobs'], transport=self.transport, cache=self.refreshCache, courseFilter=self.courseFilter)]
+        changed = user.update(schedule.firstDay, schedule.termName, fetched)
+        if changed:
+            logging.warning('{}的课表有变化，已更新'.format(user.name))
+        return changed
+
+    def refreshLoop(self):
+        while not self.stopped.wait(self.refreshInterval):
+            for user in self.users.values():
+                try:
+                    if user.schedule is None:
+                        # loading failed so far
+                        self.load(user)
+                        logging.warning('已获取{}的课表'.format(user.name))
+                    else:
+                        self.refresh(user)
+                except Exception as e:
+                    logging.warning('更新{}的课表失败：{}'.format(user.name, e))
+                    logging.debug('Refresh failed', exc_info=True)
+
+    @staticmethod
+    def parseQuery(query: str) -> tuple:
+        """
+        The render key of a query string; raises ValueError if it is invalid.
+        """
+        params = urllib.parse.parse_qs(query)
+        try:
+            include = tuple(sorted(params.get('include', [])))
+            exclude = tuple(sorted(params.get('exclude', [])))
+            for rule in include + exclude:
+                argFilterRule(rule)
+        except argparse.ArgumentTypeError as e:
+            raise ValueError(str(e))
+        mode = params.get('mode', ['all'])[-1]
+        recurrence = params.get('recurrence', [None])[-1]
+        if mode not in ['all', 'any'] or recurrence not in [None, 'greedy', 'compact']:
+            raise ValueError('Invalid mode or recurrence')
+        return include, exclude, mode, recurrence
+
+    def render(self, user: ServedUser, outputFormat: str, key: tuple) -> Tuple[str, bytes]:
+        """
+        Return the ETag and body of an export, rendering it on first use.
+        """
+        with user.lock:
+            render = user.renders.get((outputFormat, key))
+            if render is not None:
+                user.renders.move_to_end((outputFormat, key))
+                return render
+            include, exclude, mode, recurrence = key
+            courseFilter = CourseFilter(include=[argFilterRule(r) for r in include], exclude=[argFilterRule(r) for r in exclude], mode=mode)
+            useLocation = self.options['useLocation']
+            if outputFormat == 'csv':
+                body = user.schedule.toCSV(useLocation=useLocation, courseFilter=courseFilter)
+            else:
+                body = user.schedule.toICal(useLocation=useLocation, courseFilter=courseFilter, recurrence=recurrence or self.options['recurrence'])
+            body = body.encode()
+            render = user.renders[(outputFormat, key)] = ('"{}"'.format(hashlib.sha1(body).hexdigest()[:20]), body)
+            while len(user.renders) > user.maxRenders:
+                user.renders.popitem(last=False)
+            if stats:
+                stats.count('renders')
+            return render
+
+    def makeHandler(self):
+        import http.server, email.utils
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+            def reply(self, status: int, body: bytes = b'', headers: dict = {}):
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
 
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                name, _, outputFormat = path.lstrip('/').rpartition('.')
+                user = server.users.get(urllib.parse.unquote(name))
+                if user is None or outputFormat not in server.contentTypes:
+                    return self.reply(404, b'Not Found\n', {'Content-Type': 'text/plain'})
+                if user.schedule is None:
+                    return self.reply(503, b'Not loaded\n', {'Content-Type': 'text/plain', 'Retry-After': str(int(server.refreshInterval))})
+                try:
+                    key = server.parseQuery(query)
+                except ValueError as e:
+                    return self.reply(400, '{}\n'.format(e).encode(), {'Content-Type': 'text/plain'})
+                etag, body = server.render(user, outputFormat, key)
+                headers = {'ETag': etag, 'Last-Modified': email.utils.formatdate(user.lastModified, usegmt=True), 'Cache-Control': 'no-cache'}
+                if server.notModified(self.headers, etag, user.lastModified):
+                    if stats:
+                        stats.count('notModified')
+                    return self.reply(304, headers=headers)
+                if stats:
+                    stats.count('served')
+                headers['Content-Type'] = server.contentTypes[outputFormat]
+                self.reply(200, body, headers)
+
+            do_HEAD = do_GET
+
+        return Handler
+
+    @staticmethod
+    def notModified(headers, etag: str, lastModified: int) -> bool:
+        import email.utils
+        ifNoneMatch = headers.get('If-None-Match')
+        if ifNoneMatch is not None:
+            return ifNoneMatch.strip() == '*' or etag in [t.strip() for t in ifNoneMatch.split(',')]
+        ifModifiedSince = headers.get('If-Modified-Since')
+        if ifModifiedSince is not None:
+            try:
+                return email.utils.parsedate_to_datetime(ifModifiedSince).timestamp() >= lastModified
+            except (TypeError, ValueError):
+                return False
+        return False
+
+def argAddress(x: str) -> Tuple[str, int]:
+    # '8080' or 'HOST:8080'
+    host, _, port = x.rpartition(':')
+    try:
+        return (host or '127.0.0.1', int(port))
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid address: {}'.format(x))
+
+def runServer(options: dict) -> int:
+    if options['batchFile']:
+        users = readBatch(options['batchFile'])
+    elif options['eaiSess']:
+        users = [(options['eaiSess'], 'default')]
+    else:
+        logging.error('--serve需要-k或--batch')
+        return 1
+    server = ScheduleServer(options, users, refreshInterval=options['refreshInterval'])
+    try:
+        resolved = resolveFirstDay(options, users[0][0], transport=server.transport, cache=server.cache, termTable=server.termTable, courseFilter=server.courseFilter)
+    except Exception as e:
+        # every user resolves it again when loading is retried
+        logging.warning('获取学期首日失败：{}'.format(e))
+        logging.debug('Resolving the first day failed', exc_info=True)
+        resolved = None
+    if resolved and resolved[0] == 'error':
+        return 1
+    for i, user in enumerate(server.users.values()):
+        try:
+            # the week fetched while asking for the first day belongs to the first user
+            server.load(user, resolved and (resolved if i == 0 else (resolved[0], resolved[1], {})))
+        except Exception as e:
+            logging.warning('获取{}的课表失败：{}'.format(user.name, e))
+            logging.debug('Load failed', exc_info=True)
+
+    import http.server
+    httpd = http.server.ThreadingHTTPServer(options['serve'], server.makeHandler())
+    httpd.daemon_threads = True
+    refresher = threading.Thread(target=server.refreshLoop, daemon=True)
+    refresher.start()
+    host, port = httpd.server_address[:2]
+    logging.warning('正在http://{}:{}/提供{}个用户的课表，例如http://{}:{}/{}.ics'.format(host, port, len(server.users), host, port, urllib.parse.quote(next(iter(server.users)))))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stopped.set()
+        httpd.server_close()
+        server.transport.close()
     return 0
 
+def askEaiSess() -> str:
+    logging.warning('在下面输入eai-sess的值。')
+    logging.warning('这个值可以在登录“南京大学信息门户”（https://wx.nju.edu.cn/homepage/wap/default/home）后在cookies中找到。')
+    return input()
+
+def run(options: dict) -> int:
+    eaiSess    = options['eaiSess']
+    #termLength = options['termLength']
+    outputFormat = options['outputFormat'].lower()
+    courseFilter = CourseFilter.fromOptions(options)
+
+    if options['offline'] and not options['useCache']:
+        logging.error('--offline需要使用缓存')
+        return 1
+
+    if options['delta'] and not options['statePath']:
+        logging.error('--delta需要同时指定--state')
+        return 1
+
+    if options['fromSnapshot'] and (options['serve'] or options['batchFile']):
+        logging.error('--serve和批量模式不能使用--from-snapshot')
+        return 1
+
+    # with --from-snapshot, weeks are only fetched if asked for
+    weeksGiven = options['weeks'] is not None
+    if not weeksGiven:
+        options['weeks'] = argWeekList('1-')
+
+    termOptions = splitTerms(options)
+    if len(termOptions) == 1:
+        options = termOptions[0]
+    elif options['serve'] or options['batchFile']:
+        logging.error('--serve和批量模式只支持一个学期')
+        return 1
+    if options['splitTerms'] and options['outputFile'] == '-':
+        logging.error('--split-terms不能输出到标准输出')
+        return 1
+
+    if options['serve']:
+        return runServer(options)
+
+    if options['batchFile']:
+        return runBatch(options)
+
+    transport = makeTransport(options)
+    cache = makeCache(options)
+    termTable = makeTermTable(options)
+    # snapshots keep every course, the filter is applied when exporting
+    parseFilter = None if options['snapshot'] or options['fromSnapshot'] else courseFilter
+
+    if options['fromSnapshot']:
+        if options['termName'] or options['firstDay']:
+            logging.warning('使用快照中的学期，忽略-t和-d')
+        labels, schedules = ScheduleSnapshot.load(options['fromSnapshot'])
+        logging.warning('已从快照读取{}'.format('、'.join(s.termName for s in schedules)))
+        if weeksGiven:
+            if len(schedules) != 1:
+                logging.error('快照中有多个学期时不能使用-w')
+                return 1
+            schedule = schedules[0]
+            update = fetchSchedule(eaiSess or askEaiSess(), schedule.firstDay, options['weeks'], options['maxWeeks'], options['uri'], jobs=options['jobs'], transport=transport, cache=cache, courseFilter=parseFilter)
+            schedule.updateWeeks(update.weeks)
+            logging.warning('已将第{}周合并到快照的课表中'.format(formatWeeksOfMask(weekMaskOf(w.weekNumber for w in update.weeks))))
+        outputFileName, outputFormat, outputFileSuffix = resolveOutput(options['outputFile'], outputFormat)
+    else:
+        eaiSess = eaiSess or askEaiSess()
+        if len(termOptions) == 1:
+            # store first day of term in firstDay
+            resolved = resolveFirstDay(options, eaiSess, transport=transport, cache=cache, termTable=termTable, courseFilter=parseFilter)
+            if resolved[0] == 'error':
+                return 1
+        else:
+            logging.warning('共{}个学期：{}'.format(len(termOptions), '，'.join(map(termLabel, termOptions))))
+
+        # determine output file name and format (and suffix)
+        outputFileName, outputFormat, outputFileSuffix = resolveOutput(options['outputFile'], outputFormat)
+
+        if len(termOptions) == 1:
+            schedules = [fetchTermSchedule(options, eaiSess, transport, cache=cache, termTable=termTable, courseFilter=parseFilter, resolved=resolved)]
+        else:
+            schedules = fetchTermSchedules(termOptions, eaiSess, transport, cache=cache, termTable=termTable, courseFilter=parseFilter)
+        if 'error' in schedules:
+            return 1
+        labels = [termLabel(o) for o in termOptions]
+
+    if len(schedules) == 1:
+        outputs = [(schedules[0], outputFileName, options['statePath'])]
+    elif options['splitTerms']:
+        outputs = [(s, termFileName(outputFileName, label), termFileName(options['statePath'], label) if options['statePath'] else None) for label, s in zip(labels, schedules)]
+    else:
+        outputs = [(UScheduleSet(schedules), outputFileName, options['statePath'])]
+
+    opened, reused = transport.connectionStats()
+    logging.warning('共发送{}个请求（重试{}次），新建{}个连接，复用连接{}次'.format(transport.requestCount, transport.retryCount, opened, reused))
+    transport.close()
+    if cache:
+        logging.warning('缓存命中{}次，未命中{}次，写入{}次，淘汰{}项'.format(cache.hits, cache.misses, cache.stores, cache.evictions))
+    if stats:
+        stats.count('httpRequests', transport.requestCount)
+        stats.count('httpRetries', transport.retryCount)
+        stats.count('weeks', sum(len(s.weeks) for s in schedules))
+        stats.count('courses', sum(len(s.courses) for s in schedules))
+        if cache:
+            stats.count('cacheHits', cache.hits)
+            stats.count('cacheMisses', cache.misses)
+
+    if options['snapshot'] and not options['actDryRun']:
+        ScheduleSnapshot.save(options['snapshot'], labels, schedules)
+        logging.warning('快照已保存到{}。'.format(options['snapshot']))
+
+    # warn if file format and suffix do not match
+    if outputFormat != outputFileSuffix and outputFileSuffix in supportedFileFormats:
+        logging.warning('导出为{}格式，但输出文件名后缀为{}'.format(outputFormat, outputFileSuffix))
+
+    for schedule, fileName, statePath in outputs:
+        writeSchedule(schedule, fileName, outputFormat, options, courseFilter=courseFilter, statePath=statePath)
+
+    return 0
+
+def reportStats(path: str):
+    if path == '-':
+        for line in stats.table():
+            logging.warning(line)
+        return
+    with open(path, 'w') as f:
+        json.dump(stats.toJSON(), f, indent=2)
+    logging.warning('统计数据已保存到{}'.format(path))
+
+def main():
+    global stats
+    options = readOptions()
+    logging.getLogger().setLevel(options['logLevel'].upper())
+    if options['stats']:
+        stats = Stats()
+    if options['profile']:
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            status = profiler.runcall(run, options)
+        finally:
+            profiler.dump_stats(options['profile'])
+            logging.warning('性能分析数据已保存到{}'.format(options['profile']))
+    else:
+        status = run(options)
+    if stats:
+        reportStats(options['stats'])
+    return status
+
 if __name__ == '__main__':
     exit(main())
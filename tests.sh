@@ -19,3 +19,23 @@ echo $key | $prog -f ics -t 20192 -w 5,6-13,19
 $prog -f ics -c 0000 -o - -k $key
 echo $key | $prog -f ics -n 英 -o -
 echo $key | $prog -o -n 形式 -c 0
+# Filters
+$prog -f csv -i teacher=张 -x weekday=6,7 -o - -k $key
+$prog -f ics -i weeks=1-8 -i name=英 --filter-mode any -o - -k $key
+# Several terms
+$prog -t 20191-20202 -f csv -o - -k $key
+$prog -t 20191,20192 --split-terms -o "/tmp/kb-{term}.ics" -k $key
+# Snapshots
+$prog -t 20192 --snapshot /tmp/kb.kbss -f csv -o - -k $key
+$prog --from-snapshot /tmp/kb.kbss -n 英 -L -o -
+$prog --from-snapshot /tmp/kb.kbss -w 8- --snapshot /tmp/kb.kbss -o - -k $key
+# Batch
+printf "%s alice\n%s bob\n" $key $key | $prog --batch - --batch-output "/tmp/kb-{name}.{format}" -f csv
+# Subscription server, stop with ^C
+# $prog -k $key --serve 8080; curl http://127.0.0.1:8080/default.ics
+# Against the local stand-in, no eai-sess needed
+./fakeportal.py --port 8765 --error-rate 0.05 & fake=$!
+sleep 1
+$prog --uri http://127.0.0.1:8765/njukb/wap/default/classes -k x -t 20192 --no-cache -o -
+kill $fake
+./bench.py suite --courses 50 500 -o /tmp/kb-bench.json